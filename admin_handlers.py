@@ -15,17 +15,26 @@
 """Admin handlers to browse and download uploaded bundles."""
 
 import collections
+import csv
+import datetime
+import io
 import logging
 import os
+import urllib
 
 import env
+import frontend_utils
 import jinja2
 import webapp2
-# pylint: disable=unused-import
+import x5_cleanup
+import x5_exceptions
 import x5_transform
+import x5_zipstream
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import users
+from google.appengine.ext import blobstore
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from google.appengine.ext.webapp import blobstore_handlers
 
@@ -40,36 +49,255 @@ JINJA_ENVIRONMENT = jinja2.Environment(
 )
 
 
+_PAGE_SIZE = 100
+_DATE_FORMAT = '%Y-%m-%d'
+# Size of the blob reads when exporting bundles, the maximum for one fetch.
+_EXPORT_CHUNK_SIZE = blobstore.MAX_BLOB_FETCH_SIZE
+# Bundle bytes in one export archive, under the runtime response limit.
+_EXPORT_MAX_BYTES = 24 * 1024 * 1024
+_EXPORT_MANIFEST = 'manifest.csv'
+# Archive entry with the URL of the next part of a split export.
+_EXPORT_NEXT = 'next.txt'
+_EXPORT_MANIFEST_FIELDS = (
+    'creative_id', 'network_code', 'filename', 'created', 'size', 'archive_name'
+)
+
+
 DownloadItem = collections.namedtuple(
-    'DownloadItem', 'key filename creative_id blob_key created'
+    'DownloadItem', 'key filename creative_id blob_key created network_code'
 )
 
 
+def _parse_date(value):
+  if not value:
+    return None
+  return datetime.datetime.strptime(value, _DATE_FORMAT)
+
+
+def _request_filters(request):
+  """Returns the listing filters from the request, raises ValueError."""
+  filters = {
+      'network_code': request.GET.get('network') or None,
+      'created_from': _parse_date(request.GET.get('from')),
+      'created_to': _parse_date(request.GET.get('to')),
+  }
+  if filters['created_to']:
+    # Make the end date inclusive.
+    filters['created_to'] += datetime.timedelta(days=1)
+  return filters
+
+
 class IndexHandler(webapp2.RequestHandler):
 
   def get(self):
     if not users.is_current_user_admin():
       self.abort(400)
-    query = ndb.gql('''
-        select creative_id, filename, blob_key, created
-        from X5Transform
-        order by created desc
-    ''')
+    try:
+      filters = _request_filters(self.request)
+      creatives, cursor, more = x5_transform.X5SubmittedCreative.listing(
+          _PAGE_SIZE, self.request.GET.get('cursor'), **filters
+      )
+    except ValueError:
+      self.abort(400, 'invalid date')
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+      self.abort(400, 'invalid cursor')
+    results = [
+        DownloadItem(
+            c.transform_key, c.filename, c.creative_id, c.blob_key, c.created,
+            c.network_code
+        ) for c in creatives
+    ]
+    params = dict((k, self.request.GET.get(k) or '') for k in (
+        'network', 'from', 'to'
+    ))
+    next_url = None
+    if more and cursor:
+      next_url = '/admin/?%s' % urllib.urlencode(
+          dict(params, cursor=cursor.urlsafe())
+      )
     template = JINJA_ENVIRONMENT.get_template('admin.html')
-    results = []
-    filenames = set()
-    for r in query:
-      if not r.creative_id:
-        continue
-      filename = os.path.basename(r.filename)
-      if filename in filenames:
+    self.response.write(template.render({
+        'results': results, 'filters': params, 'next_url': next_url,
+        'xsrf_token': frontend_utils.generate_token()
+    }))
+
+
+def _blob_chunks(fetch, size, first):
+  """Yields the blob data in chunks, starting with the prefetched first one."""
+  yield first
+  for start in xrange(len(first), size, _EXPORT_CHUNK_SIZE):
+    yield fetch(start, min(size, start + _EXPORT_CHUNK_SIZE))
+
+
+def _export_part(transforms):
+  """Returns the transforms that fit in one export archive.
+
+  Args:
+    transforms: an iterable of submitted transforms in export order.
+
+  Returns:
+    A (part, more) tuple, part being a list of (transform, blob size) tuples
+    and more True if transforms were left out. The size is None for blobs
+    that cannot be read, which are skipped by the export.
+  """
+  storage = x5_transform.X5Transform.storage
+  part = []
+  total = 0
+  for x5transform in transforms:
+    try:
+      size = storage.size(x5transform.blob_key)
+    except x5_exceptions.X5StorageError as e:
+      logger.error('Skipping blob for creative %s: %s',
+                   x5transform.creative_id, e)
+      size = None
+    if part and total + (size or 0) > _EXPORT_MAX_BYTES:
+      return part, True
+    part.append((x5transform, size))
+    total += size or 0
+  return part, False
+
+
+def _export_stream(part, next_url=None):
+  """Yields a zip archive of the transforms bundles and a CSV manifest.
+
+  Each blob is opened and its first chunk read before anything is written
+  for it, so blobs that cannot be read are left out of the archive. If
+  next_url is set, it is stored in the archive as the link to the next part
+  of the export.
+  """
+  storage = x5_transform.X5Transform.storage
+  stream = x5_zipstream.ZipStream()
+  manifest = []
+  for x5transform, size in part:
+    if size is None:
+      continue
+    try:
+      fetch = storage.fetcher(x5transform.blob_key)
+    except x5_exceptions.X5StorageError as e:
+      logger.error('Skipping blob for creative %s: %s',
+                   x5transform.creative_id, e)
+      continue
+    with fetch:
+      try:
+        first = fetch(0, min(size, _EXPORT_CHUNK_SIZE))
+      except x5_exceptions.X5StorageError as e:
+        logger.error('Skipping blob for creative %s: %s',
+                     x5transform.creative_id, e)
         continue
-      filenames.add(filename)
-      item = DownloadItem(
-          r.key, filename, r.creative_id, r.blob_key, r.created
+      archive_name = u'%s - %s - %s' % (
+          x5transform.creative_id, x5transform.x5_id,
+          os.path.basename(x5transform.filename or '')
       )
-      results.append(item)
-    self.response.write(template.render({'results': results}))
+      for data in stream.write(
+          archive_name, _blob_chunks(fetch, size, first), x5transform.created
+      ):
+        yield data
+    manifest.append((
+        x5transform.creative_id, x5transform.network_code,
+        (x5transform.filename or u'').encode('utf-8'),
+        x5transform.created.strftime('%Y-%m-%d %H:%M:%S'),
+        size, archive_name.encode('utf-8')
+    ))
+  buf = io.BytesIO()
+  writer = csv.writer(buf)
+  writer.writerow(_EXPORT_MANIFEST_FIELDS)
+  writer.writerows(manifest)
+  for data in stream.write(
+      _EXPORT_MANIFEST, [buf.getvalue()],
+      compress_type=x5_zipstream.ZIP_DEFLATED
+  ):
+    yield data
+  if next_url:
+    for data in stream.write(_EXPORT_NEXT, [next_url + '\n']):
+      yield data
+  for data in stream.close():
+    yield data
+
+
+class ExportHandler(webapp2.RequestHandler):
+  """Returns a zip archive of the submissions matching the listing filters.
+
+  Responses are buffered by the runtime, so large exports are split in
+  parts of at most _EXPORT_MAX_BYTES of bundles. The URL of the next part is
+  returned in the X-X5-Export-Next header and in the archive.
+  """
+
+  def get(self):
+    if not users.is_current_user_admin():
+      self.abort(400)
+    try:
+      filters = _request_filters(self.request)
+      creative_ids = [
+          int(i) for i in self.request.GET.get('creative_ids', '').split(',')
+          if i.strip()
+      ]
+      offset = int(self.request.GET.get('offset') or 0)
+      cursor = self.request.GET.get('cursor')
+      cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    except (ValueError, datastore_errors.BadValueError):
+      self.abort(400, 'invalid filters')
+    model = x5_transform.X5Transform
+    params = dict(
+        (k, self.request.GET[k]) for k in ('network', 'from', 'to',
+                                           'creative_ids')
+        if self.request.GET.get(k)
+    )
+    if creative_ids:
+      # Few explicit ids, apply the other filters in memory to avoid
+      # needing composite indexes for the IN query, which has no cursors.
+      transforms = sorted((
+          t for t in model.query(model.creative_id.IN(creative_ids)) if (
+              (not filters['network_code'] or
+               t.network_code == filters['network_code']) and
+              (not filters['created_from'] or
+               t.created >= filters['created_from']) and
+              (not filters['created_to'] or t.created < filters['created_to'])
+          )
+      ), key=lambda t: (t.created, t.x5_id), reverse=True)
+      part, more = _export_part(transforms[offset:])
+      params['offset'] = offset + len(part)
+    else:
+      submitted = model.filtered(**filters).iter(
+          start_cursor=cursor, produce_cursors=True, batch_size=_PAGE_SIZE
+      )
+      part, more = _export_part(t for t in submitted if t.creative_id)
+      if more:
+        params['cursor'] = submitted.cursor_before().urlsafe()
+    next_url = None
+    if more:
+      next_url = '%s/admin/export/?%s' % (
+          self.request.host_url, urllib.urlencode(params)
+      )
+      self.response.headers['X-X5-Export-Next'] = next_url
+    self.response.headers['Content-Type'] = 'application/zip'
+    self.response.headers['Content-Disposition'] = (
+        'attachment; filename="x5-export-%s.zip"' %
+        datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    )
+    self.response.app_iter = _export_stream(part, next_url)
+
+
+class CleanupHandler(webapp2.RequestHandler):
+  """Starts the deletion of expired transforms and blobs, run from cron."""
+
+  def get(self):
+    cron = self.request.headers.get('X-Appengine-Cron') == 'true'
+    if not cron and not users.is_current_user_admin():
+      self.abort(400)
+    deferred.defer(x5_cleanup.run_cleanup)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write('cleanup started')
+
+
+class ReindexHandler(webapp2.RequestHandler):
+  """Starts the backfill of the submitted creatives listing index."""
+
+  @frontend_utils.xsrf_valid
+  def post(self):
+    if not users.is_current_user_admin():
+      self.abort(400)
+    deferred.defer(x5_transform.backfill_submitted_creatives)
+    self.redirect('/admin/')
 
 
 class DownloadHandler(blobstore_handlers.BlobstoreDownloadHandler):
@@ -91,5 +319,8 @@ class DownloadHandler(blobstore_handlers.BlobstoreDownloadHandler):
 
 app = webapp2.WSGIApplication([
     (r'/admin/?', IndexHandler),
+    (r'/admin/reindex/?', ReindexHandler),
+    (r'/admin/export/?', ExportHandler),
+    (r'/admin/cleanup/?', CleanupHandler),
     (r'/admin/download/([^/]+)/?', DownloadHandler),
 ], config={}, debug=env.DEBUG)
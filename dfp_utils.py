@@ -17,6 +17,7 @@
 import functools
 import logging
 import sys
+import threading
 
 import env
 
@@ -88,6 +89,121 @@ class MemcacheCache(Cache):
     return
 
 
+class _SingleFlightCall(object):
+  """An in-flight call whose outcome is shared by all concurrent callers."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exc_info = None
+
+
+class _SingleFlight(object):
+  """Coalesces concurrent identical calls into a single in-flight call.
+
+  The first caller for a key runs the function, callers arriving while it is
+  still running wait for it and receive the same result or exception. Nothing
+  is cached once the call completes.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+  def do(self, key, f, *args, **kwargs):
+    """Runs f, or waits for the identical call already in flight."""
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = _SingleFlightCall()
+    if not leader:
+      call.done.wait()
+      if call.exc_info:
+        raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+      return call.result
+    try:
+      call.result = f(*args, **kwargs)
+    except:  # pylint: disable=bare-except
+      call.exc_info = sys.exc_info()
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+    return call.result
+
+
+_single_flight_group = _SingleFlight()
+
+# Maximum number of concurrent API calls made by fan_out.
+_FAN_OUT_CONCURRENCY = 4
+
+
+def fan_out(f, keys, concurrency=_FAN_OUT_CONCURRENCY):
+  """Calls f(key) for each key, with at most concurrency calls in flight.
+
+  Args:
+    f: the function to call, typically submitting to a network.
+    keys: the arguments to call f with, typically network codes.
+    concurrency: the maximum number of threads used.
+
+  Returns:
+    A dict of (result, exception) tuples by key, exception being None if the
+    call succeeded.
+  """
+  pending = list(reversed(keys))
+  results = {}
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      with lock:
+        if not pending:
+          return
+        key = pending.pop()
+      try:
+        result = f(key), None
+      except Exception as e:  # pylint: disable=broad-except
+        logger.warning('Call for %s failed', key, exc_info=True)
+        result = None, e
+      with lock:
+        results[key] = result
+
+  threads = [
+      threading.Thread(target=worker)
+      for _ in range(min(concurrency, len(pending)))
+  ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
+
+def _credentials_key(credentials):
+  """Returns a key identifying the user behind a set of credentials."""
+  # Each request loads its own credentials instance, so compare the token.
+  return getattr(credentials, 'access_token', None) or id(credentials)
+
+
+def _single_flight(f):
+  """Shares one in-flight call among concurrent identical read calls.
+
+  The wrapped function must take credentials as its first argument, and all
+  other arguments must be hashable. Callers receive the same result object,
+  which must be treated as read-only.
+  """
+  @functools.wraps(f)
+  def wrapper(credentials, *args, **kwargs):
+    key = (
+        f.__name__, _credentials_key(credentials), args,
+        tuple(sorted(kwargs.items()))
+    )
+    return _single_flight_group.do(key, f, credentials, *args, **kwargs)
+  return wrapper
+
+
 def _dfp_api_error_converter(f):
   """Converts the very generic WebFault to an actionable exception."""
   @functools.wraps(f)
@@ -166,6 +282,7 @@ def do_query(method, query, values):
   return data
 
 
+@_single_flight
 @_dfp_api_error_converter
 def _get_network_user(credentials, network_code):
   network_client = get_client(credentials, network_code)
@@ -174,6 +291,7 @@ def _get_network_user(credentials, network_code):
   ).getCurrentUser()
 
 
+@_single_flight
 @_dfp_api_error_converter
 def current_user_networks(credentials):
   """Fetches user networks from DFP.
@@ -219,6 +337,7 @@ def current_user_networks(credentials):
   return networks
 
 
+@_single_flight
 @_dfp_api_error_converter
 def advertisers_list(credentials, network_code, prefix=None, as_dict=False):
   """Fetches list of advertisers for network_code, with optional prefix filter.
@@ -259,3 +378,23 @@ def submit_creative(credentials, network_code, creative):
   client = get_client(credentials, network_code)
   service = client.GetService('CreativeService', version=env.DFP_API_VERSION)
   return service.createCreatives([creative])
+
+
+@_dfp_api_error_converter
+def get_creative(credentials, network_code, creative_id):
+  """Fetches a creative by id, returns None if not found."""
+  client = get_client(credentials, network_code)
+  service = client.GetService('CreativeService', version=env.DFP_API_VERSION)
+  result = do_query(service.getCreativesByStatement, 'WHERE id = :id', [{
+      'key': 'id',
+      'value': {'xsi_type': 'NumberValue', 'value': creative_id}
+  }])
+  return result[0] if result else None
+
+
+@_dfp_api_error_converter
+def update_creative(credentials, network_code, creative):
+  """Updates an existing creative, which must include its id."""
+  client = get_client(credentials, network_code)
+  service = client.GetService('CreativeService', version=env.DFP_API_VERSION)
+  return service.updateCreatives([creative])
@@ -25,7 +25,29 @@ SERVER_SOFTWARE = os.environ.get('SERVER_SOFTWARE', '')
 
 DFP_API_VERSION = os.environ.get('DFP_API_VERSION', 'v201711')
 DFP_APP_NAME = os.environ.get('DFP_APP_NAME', 'x5')
-ASSET_SIZE_LIMIT = os.environ.get('ASSET_SIZE_LIMIT', 1000000)
+ASSET_SIZE_LIMIT = int(os.environ.get('ASSET_SIZE_LIMIT', 1000000))
+# Template for hosted GWD runtime scripts, with %(source)s, %(version)s and
+# %(type)s fields from the script tag; GWD runtimes are uploaded if empty.
+GWD_RUNTIME_URL = os.environ.get(
+    'GWD_RUNTIME_URL',
+    'https://s0.2mdn.net/ads/studio/cached_libs/%(source)s'
+)
+# Upload the Hype generated script as an asset instead of inlining it.
+HYPE_EXTERNAL_SCRIPT = bool(os.environ.get('HYPE_EXTERNAL_SCRIPT', ''))
+# Binary assets up to this size are inlined as data URIs, 0 disables it.
+DATA_URI_SIZE_LIMIT = int(os.environ.get('DATA_URI_SIZE_LIMIT', 0))
+# Recompress image assets over the size limit so that they can be uploaded.
+OPTIMIZE_IMAGES = bool(os.environ.get('OPTIMIZE_IMAGES', ''))
+# Strip comments and whitespace from converted scripts, styles and HTML.
+MINIFY = bool(os.environ.get('MINIFY', ''))
+# Merge consecutive script and stylesheet assets loaded by a snippet.
+CONCAT_ASSETS = bool(os.environ.get('CONCAT_ASSETS', ''))
+# Reference assets already uploaded to a network by id instead of content.
+REUSE_NETWORK_ASSETS = bool(os.environ.get('REUSE_NETWORK_ASSETS', ''))
+# Transforms not submitted to DFP are deleted with their blob after this time.
+TRANSFORM_RETENTION_HOURS = int(os.environ.get('TRANSFORM_RETENTION_HOURS', 24))
+# Submitted transforms are deleted after this time, 0 keeps them forever.
+SUBMITTED_RETENTION_DAYS = int(os.environ.get('SUBMITTED_RETENTION_DAYS', 0))
 
 DEBUG = False
 
@@ -14,10 +14,12 @@
 
 """Appengine app and app handlers for x5."""
 
+import copy
 import json
 import logging
 import os
 import urllib
+import uuid
 
 import dfp_utils
 import env
@@ -27,12 +29,14 @@ import oauth2_utils
 import webapp2
 import x5_exceptions
 import x5_transform
+import x5_zipcheck
 
 from webapp2_extras import sessions
 
 from google.appengine.api import blobstore
 from google.appengine.api import datastore_errors
 from google.appengine.api import users
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from google.appengine.ext.webapp import blobstore_handlers
 
@@ -60,6 +64,10 @@ JINJA_ENVIRONMENT.filters['x5_encode'] = frontend_utils.jinja_x5_encode
 # tool.
 _BUNDLE_MAX_UPLOAD_BYTES = 50*1024*1024
 
+# Number of transforms shown in the index page, and fetched by each request
+# for older transforms.
+_TRANSFORMS_PAGE_SIZE = 20
+
 
 class BaseHandler(webapp2.RequestHandler):
   """Base handler class implementing sessions and JSON response."""
@@ -108,21 +116,69 @@ class IndexHandler(BaseHandler):
   @dfp_decorator.dfp_access_required
   def get(self):
     user = users.get_current_user()
+    # The listing query and the upload URL RPC run while the page is built.
+    page = x5_transform.X5Transform.user_transforms_page_async(
+        user.user_id(), _TRANSFORMS_PAGE_SIZE
+    )
+    upload_url = blobstore.create_upload_url_async(
+        '/upload/',
+        max_bytes_total=_BUNDLE_MAX_UPLOAD_BYTES)
+    xsrf_token = frontend_utils.generate_token()
+    flashes = self.session.get_flashes(key='index')
+    transforms, cursor, more = page.get_result()
     template_values = {
-        'xsrf_token': frontend_utils.generate_token(),
-        'upload_action': blobstore.create_upload_url(
-            '/upload/',
-            max_bytes_total=_BUNDLE_MAX_UPLOAD_BYTES),
+        'xsrf_token': xsrf_token,
+        'upload_action': upload_url.get_result(),
         'x5_networks': sorted(self.x5_networks.values()),
-        'x5_transforms': list(x5_transform.X5Transform.user_transforms(
-            user.user_id()
-        )),
-        'flashes': self.session.get_flashes(key='index')
+        'x5_transforms': transforms,
+        'x5_cursor': cursor.urlsafe() if more and cursor else None,
+        'flashes': flashes
     }
     template = JINJA_ENVIRONMENT.get_template('index.html')
     self.response.write(template.render(template_values))
 
 
+class TransformsHandler(BaseHandler):
+  """Returns the next page of the user transforms listing as table rows."""
+
+  @frontend_utils.xsrf_valid
+  def get(self):
+    user_id = users.get_current_user().user_id()
+    try:
+      transforms, cursor, more = (
+          x5_transform.X5Transform.user_transforms_page(
+              user_id, _TRANSFORMS_PAGE_SIZE, self.request.GET.get('cursor')
+          )
+      )
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+      self.abort(400, 'invalid cursor')
+    template = JINJA_ENVIRONMENT.get_template('transform_rows.html')
+    self.write_json({
+        'rows': template.render({'x5_transforms': transforms}),
+        'cursor': cursor.urlsafe() if more and cursor else None
+    })
+
+
+class PreviewHandler(BaseHandler):
+  """Redirects to the DFP preview of a submitted transform."""
+
+  def get(self, transform_urlkey):
+    user_id = users.get_current_user().user_id()
+    try:
+      x5transform = ndb.Key(urlsafe=transform_urlkey).get()
+    except datastore_errors.Error:
+      logger.critical('No transform for key %s', transform_urlkey)
+      self.abort(500, 'no object')
+    if x5transform is None or not x5transform.creative_preview:
+      self.abort(404, 'no object')
+    parent = x5transform.key.parent()
+    if parent is None or parent.id() != user_id:
+      logger.warning('User id %s does not own transform %s',
+                     user_id, transform_urlkey)
+      self.abort(400, 'wrong user id')
+    self.redirect(str(x5transform.creative_preview))
+
+
 class LogoutHandler(BaseHandler):
   """Logs out the user, and deletes session variables."""
 
@@ -133,67 +189,302 @@ class LogoutHandler(BaseHandler):
 
 
 class ZipUploadHandler(BaseHandler, blobstore_handlers.BlobstoreUploadHandler):
-  """Receives blob, save X5 object and redirect."""
+  """Receives blobs, save X5 objects and redirect."""
 
   @frontend_utils.xsrf_valid
   @dfp_decorator.dfp_access_required
   def post(self):
     # TODO(ludomagno): trap DeadlineExceededError in a task handler
     # https://cloud.google.com/appengine/articles/deadlineexceedederrors?hl=en
-    try:
-      blob_info = self.get_uploads()[0]
-    except IndexError:
+    blob_infos = self.get_uploads()
+    if not blob_infos:
       logger.warning('No uploaded blobs')
       self.abort(500)
 
-    blob_key = blob_info.key()
     network_code = self.request.POST.get('network')
     user_id = users.get_current_user().user_id()
 
     logger.info(
-        'upload for network %s from user %s key %s',
-        network_code, user_id, blob_key
+        'upload for network %s from user %s keys %s',
+        network_code, user_id, ', '.join(str(b.key()) for b in blob_infos)
     )
 
-    # TODO(ludomagno): check that the blob is actually a zip file
-    #                  don't leave it for when we parse it in x5_bundle
     network = self.x5_networks.get(network_code)
     if not network:
+      x5_transform.X5Transform.storage.delete([b.key() for b in blob_infos])
       self.abort(400)
 
-    filename = frontend_utils.decode_header(getattr(blob_info, 'filename', ''))
+    # Look for earlier uploads of the same content while the zips are read.
+    previous = {}
+    for blob_info in blob_infos:
+      content_hash = getattr(blob_info, 'md5_hash', None)
+      if content_hash and content_hash not in previous:
+        previous[content_hash] = (
+            x5_transform.X5Transform.find_by_content_async(content_hash)
+        )
+
+    blob_infos = self._validate(blob_infos)
+    if not blob_infos:
+      self.redirect('/')
+      return
 
+    batch_id = uuid.uuid4().hex if len(blob_infos) > 1 else None
+    # Blob keys by content hash, for identical files in the same upload.
+    blob_keys = {}
+    duplicates = []
+    transforms = []
     try:
-      x5transform = x5_transform.X5Transform(
-          parent=x5_transform.X5Transform.parent_key(user_id),
-          blob_key=blob_key, network_code=network_code,
-          filename=filename or None
-      )
-      x5_key = x5transform.put()
-    except (blobstore.Error, datastore_errors.Error) as e:
+      for blob_info, manifest in blob_infos:
+        blob_key = blob_info.key()
+        filename = frontend_utils.decode_header(
+            getattr(blob_info, 'filename', '')
+        )
+        content_hash = getattr(blob_info, 'md5_hash', None)
+        if content_hash and content_hash not in blob_keys:
+          earlier = previous[content_hash].get_result()
+          blob_keys[content_hash] = earlier.blob_key if earlier else blob_key
+        if content_hash and blob_keys[content_hash] != blob_key:
+          # Share the blob of the identical bundle, and its cached transform.
+          logger.info('upload %s has the same content as %s', blob_key,
+                      blob_keys[content_hash])
+          duplicates.append(blob_key)
+          blob_key = blob_keys[content_hash]
+        transforms.append(x5_transform.X5Transform(
+            parent=x5_transform.X5Transform.parent_key(user_id),
+            blob_key=blob_key, network_code=network_code,
+            filename=filename or None, content_hash=content_hash,
+            snippet=(
+                manifest.snippets[0] if len(manifest.snippets) == 1 else None
+            ),
+            batch_id=batch_id,
+            status=x5_transform.STATUS_PENDING if batch_id else None,
+            entry_count=len(manifest.entries), content_size=manifest.size,
+            snippet_names=[
+                name.decode('utf-8', 'replace') for name in manifest.snippets
+            ]
+        ))
+      futures = ndb.put_multi_async(transforms)
+      if duplicates:
+        x5_transform.X5Transform.storage.delete(duplicates)
+      x5_keys = [future.get_result() for future in futures]
+    except (x5_exceptions.X5StorageError, datastore_errors.Error) as e:
       logger.critical('Error saving x5 transform: %s', e)
       self.abort(500)
 
-    self.redirect('/metadata/%s/%s/' % (
-        network_code, urllib.quote(str(x5_key.urlsafe()))
-    ))
+    if not batch_id:
+      self.redirect('/metadata/%s/%s/' % (
+          network_code, urllib.quote(str(x5_keys[0].urlsafe()))
+      ))
+      return
+
+    for x5_key in x5_keys:
+      deferred.defer(x5_transform.prepare_transform, x5_key)
+    self.redirect('/batch/%s/' % batch_id)
+
+
+  def _validate(self, blob_infos):
+    """Returns (blob_info, manifest) tuples for the valid zipped bundles.
+
+    Invalid uploads are deleted before anything refers to them, and reported
+    to the user.
+    """
+    storage = x5_transform.X5Transform.storage
+    valid = []
+    for blob_info in blob_infos:
+      filename = frontend_utils.decode_header(
+          getattr(blob_info, 'filename', '')
+      )
+      try:
+        with storage.fetcher(blob_info.key()) as fetch:
+          manifest = x5_zipcheck.validate(
+              fetch, blob_info.size, _BUNDLE_MAX_UPLOAD_BYTES
+          )
+      except x5_exceptions.X5ZipError as e:
+        logger.warning('Invalid upload %s: %s', filename, e)
+        storage.delete(blob_info.key())
+        self.session.add_flash('%s is not a valid creative bundle: %s.'
+                               '  Please ensure that it is a zip archive and'
+                               ' contains at least one HTML snippet.' % (
+                                   filename or 'The uploaded file',
+                                   e.args[0].rstrip('.')
+                               ),
+                               level='error',
+                               key='index')
+        continue
+      except x5_exceptions.X5StorageError as e:
+        logger.critical('Error reading upload %s: %s', filename, e)
+        self.abort(500)
+      valid.append((blob_info, manifest))
+    return valid
+
+
+class BatchHandler(BaseHandler):
+  """Review page for the bundles uploaded together."""
+
+  @dfp_decorator.dfp_access_required
+  def get(self, batch_id):
+    user_id = users.get_current_user().user_id()
+    transforms = x5_transform.X5Transform.user_batch(user_id, batch_id)
+    if not transforms:
+      self.abort(404, 'no batch')
+    template = JINJA_ENVIRONMENT.get_template('batch.html')
+    self.response.write(template.render({
+        'x5_transforms': transforms,
+        'pending': any(
+            t.status == x5_transform.STATUS_PENDING for t in transforms
+        ),
+        'flashes': self.session.get_flashes(key='index')
+    }))
+
+
+# Errors that a new submission without reused assets cannot fix.
+_NO_RETRY_ERRORS = (
+    dfp_utils.AuthenticationError, dfp_utils.PermissionError,
+    dfp_utils.ApiAccessError, dfp_utils.AdvertiserError
+)
+
+
+def _network_error_message(e):
+  """Returns a short description of a submission error for one network."""
+  if isinstance(e, dfp_utils.PermissionError):
+    return 'no creative editing rights on this network.'
+  if isinstance(e, dfp_utils.ApiAccessError):
+    return 'the network is not enabled for API access.'
+  if isinstance(e, dfp_utils.AdvertiserError):
+    return 'the advertiser ID is not valid for this network.'
+  if isinstance(e, dfp_utils.ServiceError):
+    return 'DFP API error: %s' % e.message
+  return 'unexpected error while uploading the creative.'
+
+
+def _submit_to_networks(x5transform, metadata, advertisers):
+  """Submits the creative to several networks concurrently.
+
+  The creative is built once, then each network gets a copy with its own
+  advertiser id and the assets already uploaded to it referenced by id.
+
+  Args:
+    x5transform: the transform to submit.
+    metadata: the get_creative arguments from the form.
+    advertisers: advertiser ids by network code.
+
+  Returns:
+    A dict of (creative_data, exception) tuples by network code, as returned
+    by dfp_utils.fan_out.
+  """
+  creative = x5transform.get_creative(**metadata)
+  payloads = {}
+  for network_code, advertiser_id in advertisers.items():
+    plain = copy.deepcopy(creative)
+    plain['advertiserId'] = advertiser_id
+    reusing = None
+    if env.REUSE_NETWORK_ASSETS:
+      reusing = copy.deepcopy(plain)
+      if not x5_transform.X5NetworkAsset.reuse(
+          network_code, reusing['customCreativeAssets'],
+          x5transform.asset_hashes):
+        reusing = None
+    payloads[network_code] = reusing, plain
+  # The decorator keeps the credentials in a thread local, unset in the
+  # fan_out threads.
+  credentials = dfp_decorator.credentials
+
+  def submit(network_code):
+    reusing, plain = payloads[network_code]
+    if reusing is not None:
+      try:
+        return dfp_utils.submit_creative(credentials, network_code, reusing)
+      except _NO_RETRY_ERRORS:
+        raise
+      except dfp_utils.ServiceError:
+        logger.warning('Creative upload to %s with reused assets failed,'
+                       ' retrying', network_code, exc_info=True)
+    return dfp_utils.submit_creative(credentials, network_code, plain)
+
+  return dfp_utils.fan_out(submit, advertisers.keys())
+
+
+@ndb.tasklet
+def _record_submission_async(x5transform, creative, advertiser_id):
+  """Stores the creative submitted from a transform and its assets ids.
+
+  The asset ids are written while the transform is saved, the submitted
+  creative index needs the key of the saved transform.
+  """
+  x5transform.creative_id = creative['id']
+  x5transform.creative_preview = creative['previewUrl']
+  x5transform.advertiser_id = int(advertiser_id)
+  assets = x5_transform.X5NetworkAsset.record_async(
+      x5transform.network_code, creative, x5transform.asset_hashes
+  )
+  yield x5transform.put_async()
+  yield x5_transform.X5SubmittedCreative.record_async(x5transform), assets
+
+
+def _submit_creative(x5transform, network_code, metadata, existing=None,
+                     previous=None):
+  """Submits the creative, reusing the assets already in the network.
+
+  If the API rejects the creative when some assets are referenced by id, as
+  happens if they have been deleted from the network, the creative is
+  submitted again with the content of all assets.
+
+  Args:
+    x5transform: the transform to submit.
+    network_code: the DFP network code.
+    metadata: the get_creative arguments from the form.
+    existing: an existing CustomCreative to update instead of creating one.
+    previous: the transform that last submitted the existing creative.
+
+  Returns:
+    The list of created or updated creatives returned by the API.
+  """
+  def submit(reuse_assets):
+    creative = x5transform.get_creative(reuse_assets=reuse_assets, **metadata)
+    if existing is None:
+      return dfp_utils.submit_creative(
+          dfp_decorator.credentials, network_code, creative
+      )
+    x5transform.as_update(creative, existing, previous)
+    return dfp_utils.update_creative(
+        dfp_decorator.credentials, network_code, creative
+    )
+
+  try:
+    return submit(env.REUSE_NETWORK_ASSETS)
+  except _NO_RETRY_ERRORS:
+    raise
+  except dfp_utils.ServiceError:
+    if not x5transform.reused_assets:
+      raise
+    logger.warning('Creative upload with %s reused assets failed, retrying',
+                   x5transform.reused_assets, exc_info=True)
+  return submit(False)
 
 
 class MetadataHandler(BaseHandler):
   """Handler for the bundle check and submission user interface."""
 
-  def _get_transform(self, network_code, transform_urlkey):
-    user = users.get_current_user()
-    user_id = user.user_id()
+  def _get_transform_async(self, network_code, transform_urlkey):
+    """Starts loading the transform, returns a future for _check_transform."""
     logger.info(
         'metadata for network %s from user %s key %s',
-        network_code, user_id, transform_urlkey
+        network_code, users.get_current_user().user_id(), transform_urlkey
     )
     network = self.x5_networks.get(network_code)
     if not network:
       self.abort(400, 'no network')
     try:
-      x5transform = ndb.Key(urlsafe=transform_urlkey).get()
+      return ndb.Key(urlsafe=transform_urlkey).get_async()
+    except datastore_errors.Error:
+      logger.critical('No transform for key %s', transform_urlkey)
+      self.abort(500, 'no object')
+
+  def _check_transform(self, network_code, transform_urlkey, future):
+    """Returns the loaded transform if it belongs to the user and network."""
+    user_id = users.get_current_user().user_id()
+    try:
+      x5transform = future.get_result()
     except datastore_errors.Error:
       # TODO(ludomagno): check for other exceptions
       logger.critical('No transform for key %s', transform_urlkey)
@@ -217,15 +508,25 @@ class MetadataHandler(BaseHandler):
       self.abort(400, 'wrong network')
     return x5transform
 
+  def _get_transform(self, network_code, transform_urlkey):
+    return self._check_transform(
+        network_code, transform_urlkey,
+        self._get_transform_async(network_code, transform_urlkey)
+    )
+
   @dfp_decorator.dfp_access_required
   def get(self, network_code, transform_urlkey):
     try:
       x5transform = self._get_transform(network_code, transform_urlkey)
+      # The query runs while the bundle is read for snippets and assets.
+      submitted = x5_transform.X5Transform.submitted_for_content_async(
+          x5transform.content_hash, network_code
+      )
       template_values = {
           'xsrf_token': frontend_utils.generate_token(),
           'transform': x5transform.to_dict(exclude=(
-              'blob_key', 'user_id', 'snippet',
-              'metadata', 'creative_id', 'uploaded'
+              'blob_key', 'user_id', 'snippet', 'metadata', 'creative_id',
+              'uploaded', 'content_hash', 'advertiser_id'
           )),
           # TODO(ludomagno): move encoding from as_dict to here
           'snippets': [
@@ -234,6 +535,13 @@ class MetadataHandler(BaseHandler):
           'assets': [
               asset.as_dict(True) for asset in x5transform.assets.values()
           ],
+          'networks': sorted(
+              n for c, n in self.x5_networks.items() if c != network_code
+          ),
+          'submitted': [
+              {'creative_id': t.creative_id, 'advertiser_id': t.advertiser_id}
+              for t in submitted.get_result()
+          ],
           'flashes': self.session.get_flashes(key='metadata')
       }
     except x5_exceptions.X5TransformError:
@@ -253,7 +561,7 @@ class MetadataHandler(BaseHandler):
   @frontend_utils.xsrf_valid
   @dfp_decorator.dfp_access_required
   def post(self, network_code, transform_urlkey):
-    x5transform = self._get_transform(network_code, transform_urlkey)
+    future = self._get_transform_async(network_code, transform_urlkey)
     metadata = {}
     for k in ('advertiser_id', 'snippet_id', 'url', 'size'):
       v = self.request.POST.get(k)
@@ -265,10 +573,51 @@ class MetadataHandler(BaseHandler):
       metadata[k] = v
     metadata['creative_name'] = self.request.POST.get('creative_name')
     metadata['interstitial'] = self.request.POST.get('interstitial', 0)
+    update_id = self.request.POST.get('update_creative_id')
+    if update_id and not update_id.isdigit():
+      self.abort(400, 'invalid creative id')
+    advertisers = {}
+    for code in self.request.POST.getall('networks'):
+      if code == network_code:
+        continue
+      if code not in self.x5_networks:
+        self.abort(400, 'no network')
+      advertiser_id = self.request.POST.get('advertiser_id_%s' % code)
+      if not advertiser_id or not advertiser_id.isdigit():
+        self.abort(400, 'no advertiser for network %s' % code)
+      advertisers[code] = advertiser_id
+    if advertisers:
+      if update_id:
+        self.abort(400, 'cannot update creatives in several networks')
+      advertisers[network_code] = metadata['advertiser_id']
+      self._post_networks(
+          self._check_transform(network_code, transform_urlkey, future),
+          metadata, advertisers
+      )
+      return
+    existing = previous = None
     try:
-      creative_data = dfp_utils.submit_creative(
-          dfp_decorator.credentials, network_code,
-          x5transform.get_creative(**metadata)
+      if update_id:
+        # The earlier submission is queried while DFP returns the creative.
+        previous = x5_transform.X5Transform.latest_for_creative_async(
+            network_code, int(update_id)
+        )
+        existing = dfp_utils.get_creative(
+            dfp_decorator.credentials, network_code, int(update_id)
+        )
+        if existing.__class__.__name__ != 'CustomCreative':
+          self.session.add_flash('The creative to update must be an existing'
+                                 ' custom creative in this DFP network.',
+                                 level='error',
+                                 key='metadata')
+          self.redirect(self.request.url)
+          return
+      x5transform = self._check_transform(
+          network_code, transform_urlkey, future
+      )
+      creative_data = _submit_creative(
+          x5transform, network_code, metadata, existing,
+          previous.get_result() if previous else None
       )
     except x5_exceptions.X5TransformError as e:
       self.abort(500, e.args[0])
@@ -307,20 +656,84 @@ class MetadataHandler(BaseHandler):
       self.abort(500, 'no creatives')
 
     try:
-      x5transform.creative_id = creative_data[0]['id']
-      x5transform.creative_preview = creative_data[0]['previewUrl']
-      x5transform.put()
+      _record_submission_async(
+          x5transform, creative_data[0], metadata['advertiser_id']
+      ).get_result()
       # TODO(ludomagno): re-enable once we don't need to save bundles anymore
-      # blobstore.delete(x5transform.blob_key)
-    except (blobstore.Error, datastore_errors.Error) as e:
+      # x5_transform.X5Transform.storage.delete(x5transform.blob_key)
+    except (x5_exceptions.X5StorageError, datastore_errors.Error) as e:
+      # The creative exists in DFP, going back to the form would let the
+      # user upload it again.
       logger.critical('Error saving x5 transform: %s', e)
-      self.abort(500, e)
+      self.session.add_flash('Creative %s was uploaded but could not be'
+                             ' saved.' % creative_data[0]['id'],
+                             level='error',
+                             key='index')
+      self.redirect('/')
+      return
 
-    self.session.add_flash('Upload successful.', key='index')
+    self.session.add_flash(
+        'Update successful.' if existing else 'Upload successful.', key='index'
+    )
 
     self.redirect('/')
 
 
+  def _post_networks(self, x5transform, metadata, advertisers):
+    """Submits the creative to several networks and flashes the results.
+
+    A sibling transform sharing the same blob is stored for each additional
+    network the creative is uploaded to.
+    """
+    try:
+      results = _submit_to_networks(x5transform, metadata, advertisers)
+    except x5_exceptions.X5TransformError as e:
+      self.abort(500, e.args[0])
+    messages = {}
+    saving = {}
+    for code in sorted(results):
+      creative_data, error = results[code]
+      if error is None and not creative_data:
+        logger.critical('No creatives from api for network %s', code)
+        error = dfp_utils.ServiceError('no creatives')
+      if error is not None:
+        messages[code] = ('Network %s: %s' % (
+            code, _network_error_message(error)
+        ), 'error')
+        continue
+      if code == x5transform.network_code:
+        target = x5transform
+      else:
+        target = x5_transform.X5Transform(
+            parent=x5transform.key.parent(), blob_key=x5transform.blob_key,
+            network_code=code, filename=x5transform.filename,
+            content_hash=x5transform.content_hash,
+            asset_hashes=x5transform.asset_hashes
+        )
+      saving[code] = _record_submission_async(
+          target, creative_data[0], advertisers[code]
+      )
+    # The submissions to all networks are saved concurrently.
+    for code, future in saving.items():
+      creative_id = results[code][0][0]['id']
+      try:
+        future.get_result()
+      except (x5_exceptions.X5StorageError, datastore_errors.Error) as e:
+        logger.critical('Error saving x5 transform: %s', e)
+        messages[code] = ('Network %s: creative %s was uploaded but could not'
+                          ' be saved.' % (code, creative_id), 'error')
+        continue
+      messages[code] = ('Network %s: upload successful, creative %s.' % (
+          code, creative_id
+      ), None)
+    messages = [messages[code] for code in sorted(messages)]
+    # Go back to the form only if nothing was uploaded.
+    key = 'index' if any(level is None for _, level in messages) else 'metadata'
+    for message, level in messages:
+      self.session.add_flash(message, level=level, key=key)
+    self.redirect('/' if key == 'index' else self.request.url)
+
+
 class AdvertisersHandler(BaseHandler):
   """Fetch advertisers from the DFP APIs for a given network."""
 
@@ -353,7 +766,10 @@ app = webapp2.WSGIApplication([
     (dfp_decorator.callback_path, dfp_decorator.callback_handler()),
     (r'/logout/?', LogoutHandler),
     (r'/?', IndexHandler),
+    (r'/transforms/?', TransformsHandler),
+    (r'/preview/([^/]+)/?', PreviewHandler),
     (r'/upload/?', ZipUploadHandler),
+    (r'/batch/([0-9a-f]+)/?', BatchHandler),
     (r'/metadata/([0-9]+)/([^/]+)/?', MetadataHandler),
     (r'/advertisers/([0-9]+)/?', AdvertisersHandler),
     (r'/advertisers/([0-9]+)/([^/]+)/?', AdvertisersHandler),
@@ -68,6 +68,12 @@ $(function() {
           icon: 'glyphicon-minus red',
           help: 'mimetype not supported by DFP',
           order: 4
+      },
+      data_uri: {
+          name: 'data URI',
+          icon: 'glyphicon-circle-arrow-down green',
+          help: 'inlined in the snippet as a data URI, will not be uploaded',
+          order: 5
       }
   };
 
@@ -111,11 +117,12 @@ $(function() {
     });
   }
 
-  function showAssets(includedNames) {
+  function showAssets(includedNames, dataUriNames) {
     /**
      * Displays the assets table, mapping icons and descriptions to each asset
      * state. Also displays a legend for states used in the table.
      * @param {!Array.<string>} includedNames Asset names to display.
+     * @param {!Array.<string>} dataUriNames Asset names inlined as data URIs.
      */
     var counts = {},
         statusIcons = [],
@@ -135,7 +142,9 @@ $(function() {
           status = 'none';
       // set status
       if (count) {
-        if (asset.inlined)
+        if (dataUriNames.indexOf(name) != -1)
+          status = 'data_uri';
+        else if (asset.inlined)
           status = 'inline';
         else if (asset.over_limit)
           status = 'self_upload';
@@ -161,7 +170,10 @@ $(function() {
         ) + '</td>' +
         '<td>' + asset.id + '</td>' +
         '<td>' + (asset.mimetype || 'unknown') + '</td>' +
-        '<td>' + asset.size + '</td>' +
+        '<td' + (asset.optimization || asset.minified_sizes ?
+          ' title="' + (asset.optimization || 'minified') + ', ' +
+          asset.bytes_saved + ' bytes saved"' : '') + '>' +
+          asset.size + '</td>' +
         '<td>' + (counts[name] ? counts[name] : '') + '</td>s</tr>'
       ).appendTo($assets);
       // download element on click if it needs to be inlined
@@ -205,10 +217,10 @@ $(function() {
     /**
      * Updates the UI to show text and assets of the selected snippet.
      */
-    $('#converted pre').text(snippet.parsed_content);
+    $('#converted pre').text(snippet.html_snippet || snippet.parsed_content);
     $('#original pre').text(snippet.content);
     PR.prettyPrint();
-    showAssets(snippet.assets);
+    showAssets(snippet.assets.concat(snippet.data_uris), snippet.data_uris);
   }
 
   // tab scroll
@@ -17,9 +17,12 @@
 import base64
 import cgi
 import collections
+import hashlib
+import io
 import logging
 import mimetypes
 import os
+import re
 import string
 import zipfile
 
@@ -27,8 +30,10 @@ import env
 from lxml import etree
 import x5_converters
 import x5_exceptions
-
-from google.appengine.ext import blobstore
+import x5_images
+import x5_minifiers
+import x5_reader
+import x5_utils
 
 
 logger = logging.getLogger('x5.bundle')
@@ -38,6 +43,43 @@ _SNIPPET_MIMETYPES = ('text/html',)
 _SCRIPT_MIMETYPES = ('application/javascript', 'application/x-javascript')
 _INLINED_MIMETYPES = ('text/css', 'text/html', 'text/plain') + _SCRIPT_MIMETYPES
 _UNSUPPORTED_MIMETYPES = ('image/svg+xml',)
+# Snippets larger than this are converted with the streaming extractor.
+_STREAMING_SNIPPET_SIZE = 512 * 1024
+_SNIPPET_HEADER = (
+    '<!-- Please make sure you review the creative and '
+    'that it contains the clicktracking macro -->'
+)
+_SKIPPED_HEAD_TAGS = ('meta', 'title')
+# Script and stylesheet tags, merged when they load a single asset macro and
+# are only separated by whitespace. Quoted attribute values may contain '>'.
+_CONCAT_TAG_REGEXP = re.compile(
+    r'<script(?=[\s/>])(?:[^>"\']|"[^"]*"|\'[^\']*\')*>\s*</script\s*>|'
+    r'<link(?=[\s/>])(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.I
+)
+_DOCUMENT_TAGS = ('html', 'head', 'body')
+_MACRO_REGEXP = re.compile(r'^%%FILE:([A-Za-z0-9]+)%%$')
+# Attributes that can be dropped from merged tags, with their allowed values
+# if restricted; anything else (async, defer, onload...) prevents merging.
+_CONCAT_ATTRS = {
+    'script': {
+        'src': None, 'charset': None, 'language': None,
+        'type': ('text/javascript', 'application/javascript')
+    },
+    'link': {
+        'href': None, 'rel': ('stylesheet',), 'type': ('text/css',),
+        'media': ('all',)
+    }
+}
+_CONCAT_MIMETYPES = {'script': _SCRIPT_MIMETYPES, 'link': ('text/css',)}
+_CONCAT_TEMPLATES = {
+    'script': '<script src="%%%%FILE:%s%%%%"></script>',
+    'link': '<link rel="stylesheet" href="%%%%FILE:%s%%%%">'
+}
+_CONCAT_SEPARATORS = {'script': '\n;\n', 'link': '\n'}
+# Directives only valid at the start of a file prevent merging.
+_CONCAT_UNSAFE_REGEXP = re.compile(
+    r'@import|@charset|[\'"]use strict[\'"]', re.I
+)
 
 
 def html_escape(s):
@@ -45,6 +87,95 @@ def html_escape(s):
   return s
 
 
+def _html_text(text):
+  """Returns text escaped as lxml escapes it when serializing an element."""
+  el = etree.Element('p')
+  el.text = text
+  return etree.tostring(el, encoding='utf-8', method='html')[3:-4]
+
+
+def concat_tag(tag):
+  """Returns (tag name, asset id) if the tag can be merged, or None."""
+  try:
+    tree = etree.HTML(tag)
+  except etree.LxmlError:
+    return None
+  if tree is None:
+    return None
+  el = next((e for e in tree.iter() if e.tag not in _DOCUMENT_TAGS), None)
+  allowed = _CONCAT_ATTRS.get(getattr(el, 'tag', None))
+  if not allowed:
+    return None
+  name, attrs = el.tag, dict(el.attrib)
+  m = _MACRO_REGEXP.match(attrs.get('src' if name == 'script' else 'href', ''))
+  if not m or (name == 'link' and 'rel' not in attrs):
+    return None
+  for attr, value in attrs.items():
+    if attr not in allowed:
+      return None
+    if allowed[attr] and value.lower() not in allowed[attr]:
+      return None
+  return name, m.group(1)
+
+
+def skipped_member(filename):
+  """Checks if a zip entry is a folder or file system metadata."""
+  if filename.endswith('/') or '__MACOSX/' in filename:
+    return True
+  basename = os.path.basename(filename)
+  return (
+      basename.startswith('.') or basename in ('Thumbs.db',) or
+      filename.endswith('.DS_Store')
+  )
+
+
+def snippet_member(filename):
+  """Checks if a zip entry is added to a bundle as a snippet."""
+  try:
+    mimetype, _ = mimetypes.guess_type(filename)
+  except TypeError:
+    return False
+  return mimetype in _SNIPPET_MIMETYPES
+
+
+def stream_snippet(content):
+  """Extracts the snippet HTML fragment, writing it out incrementally.
+
+  Produces the same output as serializing the head children and the whole
+  body then slicing and joining the strings, but each head or body child is
+  written straight to a single output buffer and removed from the tree once
+  written. Memory is bounded by the tree plus one copy of the output instead
+  of several serialized copies of the document.
+
+  Args:
+    content: the converted snippet, as utf-8 encoded bytes.
+
+  Returns:
+    The fragment as unicode.
+  """
+  # pylint: disable=no-member
+  content = content.decode('utf-8', errors='ignore')
+  tree = etree.HTML(content)
+  body = tree.find('body')
+  if body is None:
+    return content
+  head = tree.find('head')
+  del content
+  buf = io.BytesIO()
+  buf.write(_SNIPPET_HEADER)
+  if head is not None:
+    for el in list(head):
+      if not (callable(el.tag) or el.tag.lower() in _SKIPPED_HEAD_TAGS):
+        buf.write(etree.tostring(el, encoding='utf-8', method='html'))
+      head.remove(el)
+  if body.text:
+    buf.write(_html_text(body.text))
+  for el in list(body):
+    buf.write(etree.tostring(el, encoding='utf-8', method='html'))
+    body.remove(el)
+  return buf.getvalue().decode('utf-8')
+
+
 class X5CreativeResource(object):
   """Base class for HTML5 creative parts."""
 
@@ -57,6 +188,10 @@ class X5CreativeResource(object):
     self._converted = False
     self.assets = []
     self.mimetype = mimetype
+    # Names of assets inlined in the converted content as data URIs.
+    self.data_uris = []
+    # Converted content sizes before and after minification, if minified.
+    self.minified_sizes = None
 
   @property
   def root(self):
@@ -81,11 +216,16 @@ class X5CreativeResource(object):
   def converted(self):
     return self._converted
 
+  @property
+  def memory_size(self):
+    """Approximate size in bytes of the content held in memory."""
+    return len(self.content or '') + len(self._parsed_content or '')
+
   def as_dict(self, escaped=False):
     """Returns the resource as dictionary."""
     d = dict((k, getattr(self, k)) for k in (
         'id', 'name', 'size', 'content', 'parsed_content', 'assets',
-        'mimetype', 'root', 'basename'
+        'mimetype', 'root', 'basename', 'minified_sizes', 'data_uris'
     ))
     if escaped:
       # TODO(ludomagno): move escaping in main.MetadataHandler
@@ -93,8 +233,20 @@ class X5CreativeResource(object):
       d['basename'] = html_escape(d['basename'])
       d['root'] = html_escape(d['root'])
       d['assets'] = [html_escape(a) for a in d['assets']]
+      d['data_uris'] = [html_escape(a) for a in d['data_uris']]
     return d
 
+  def minify(self):
+    """Minifies the converted content in place, if it can be reduced."""
+    if not self.converted or self.minified_sizes is not None:
+      return
+    minified = x5_minifiers.minify(self.parsed_content, self.mimetype)
+    if minified is None:
+      return
+    self.minified_sizes = (len(self.parsed_content), len(minified))
+    self.size -= self.minified_sizes[0] - self.minified_sizes[1]
+    self.parsed_content = minified
+
   def name_relative_to(self, root):
     if not root:
       return self.name
@@ -113,29 +265,51 @@ class X5Snippet(X5CreativeResource):
     super(X5Snippet, self).__init__(obj_id, filename, filesize, mimetype)
     self.content = fileobj.read()
     self.assets = []
+    self._html_snippet = None
+
+  @X5CreativeResource.parsed_content.setter
+  def parsed_content(self, value):
+    X5CreativeResource.parsed_content.fset(self, value)
+    self._html_snippet = None
+
+  @property
+  def memory_size(self):
+    return (
+        super(X5Snippet, self).memory_size + len(self._html_snippet or '')
+    )
+
+  @property
+  def html_snippet(self):
+    """The HTML fragment for the DFP API as utf-8, computed once."""
+    if self._html_snippet is None:
+      self._html_snippet = self._build_snippet().encode('utf-8')
+    return self._html_snippet
 
   def as_dict(self, escaped=False):
     d = super(X5Snippet, self).as_dict(escaped)
     d['x5type'] = self.x5type
+    d['html_snippet'] = self.as_snippet()
     return d
 
   def as_snippet(self):
     """Returns snippet as HTML fragment for consumption by the DFP API."""
+    return self.html_snippet.decode('utf-8')
+
+  def _build_snippet(self):
+    """Parses the converted snippet and returns its HTML fragment."""
     # pylint: disable=no-member
     if not self.parsed_content:
-      return ''
+      return u''
+    if len(self.parsed_content) > _STREAMING_SNIPPET_SIZE:
+      return stream_snippet(self.parsed_content)
     content = self.parsed_content.decode('utf-8', errors='ignore')
     tree = etree.HTML(content)
-    buf = []
-    buf.append((
-        '<!-- Please make sure you review the creative and '
-        'that it contains the clicktracking macro -->'
-    ))
+    buf = [_SNIPPET_HEADER]
     head = tree.find('head')
     if head is not None:
       for el in head:
         # TODO(ludomagno): account for XML namespaces (consider tag from '}' ?)
-        if callable(el.tag) or el.tag.lower() in ('meta', 'title'):
+        if callable(el.tag) or el.tag.lower() in _SKIPPED_HEAD_TAGS:
           continue
         buf.append(etree.tostring(el, encoding='utf-8', method='html'))
     body = tree.find('body')
@@ -151,9 +325,29 @@ class X5Asset(X5CreativeResource):
 
   def __init__(self, obj_id, filename, filesize, mimetype, fileobj):
     super(X5Asset, self).__init__(obj_id, filename, filesize, mimetype)
+    self.original_size = filesize
+    # Recompressed content replacing the original one, and how it was made.
+    self.optimized_content = None
+    self.optimization = None
+    # Names of the assets merged into this one, if any.
+    self.combined_from = None
+    self.data_uri = None
+    # MD5 hex digest of the uploaded content, set once it has been read.
+    self.content_hash = None
     if self.inlineable:
       self.content = fileobj.read()
       self.assets = []
+    elif (env.DATA_URI_SIZE_LIMIT > 0 and
+          filesize <= env.DATA_URI_SIZE_LIMIT and not self.unsupported):
+      self.data_uri = 'data:%s;base64,%s' % (
+          self.mimetype, base64.b64encode(fileobj.read())
+      )
+
+  @property
+  def memory_size(self):
+    return super(X5Asset, self).memory_size + len(
+        self.optimized_content or ''
+    ) + len(self.data_uri or '')
 
   def as_dict(self, escaped=False):
     d = super(X5Asset, self).as_dict(escaped)
@@ -161,18 +355,45 @@ class X5Asset(X5CreativeResource):
     d['inlined'] = self.inlined
     d['over_limit'] = self.over_limit
     d['unsupported'] = self.unsupported
+    d['original_size'] = self.original_size
+    d['optimization'] = self.optimization
+    d['bytes_saved'] = self.original_size - self.size
+    d['combined_from'] = self.combined_from
     return d
 
-  def as_creative_asset(self, transform_id, fileobj):
-    """Returns asset in the format expected by the DFP API."""
-    if self.over_limit or self.unsupported:
+  def as_creative_asset(self, transform_id, fileobj, content=None,
+                        hashes=None):
+    """Returns asset in the format expected by the DFP API.
+
+    Args:
+      transform_id: the transform id, used in the asset file name.
+      fileobj: file object for the original content, if read from the zip.
+      content: optional content replacing the asset one for this creative.
+      hashes: optional dict where the content MD5 is stored by macro name.
+
+    Returns:
+      A dictionary with the CustomCreativeAsset fields.
+    """
+    content_hash = None
+    if content is not None:
+      content_hash = hashlib.md5(content).hexdigest()
+    elif self.over_limit or self.unsupported:
       content = chr(0)
+    elif self.optimized_content is not None:
+      content = self.optimized_content
     elif self.inlineable:
       content = self.parsed_content or self.content
       if isinstance(content, unicode):
         content = content.encode('utf-8')
     else:
       content = fileobj.read()
+    if content_hash is None:
+      # The content is the same for all creatives, only hash it once.
+      if self.content_hash is None:
+        self.content_hash = hashlib.md5(content).hexdigest()
+      content_hash = self.content_hash
+    if hashes is not None:
+      hashes[self.id] = content_hash
     return {
         'xsi_type': 'CustomCreativeAsset',
         'macroName': self.id,
@@ -185,6 +406,34 @@ class X5Asset(X5CreativeResource):
         }
     }
 
+  @property
+  def from_zip(self):
+    """Checks if the uploaded content has to be read from the zipped bundle."""
+    return not (
+        self.over_limit or self.unsupported or self.inlineable or
+        self.optimized_content is not None
+    )
+
+  @property
+  def optimizable(self):
+    return self.mimetype in x5_images.OPTIMIZABLE_MIMETYPES
+
+  def optimize(self, fileobj, max_size=None):
+    """Returns recompressed content fitting the size limit, or None.
+
+    Args:
+      fileobj: file object for the original asset content.
+      max_size: optional (width, height) the image can be downscaled to.
+
+    Returns:
+      A (content, method) tuple, or None if the asset cannot be made to fit.
+    """
+    if not self.optimizable:
+      return None
+    return x5_images.optimize(
+        fileobj.read(), self.mimetype, env.ASSET_SIZE_LIMIT, max_size
+    )
+
   @property
   def over_limit(self):
     return self.size > env.ASSET_SIZE_LIMIT
@@ -208,8 +457,8 @@ class X5Bundle(object):
   @classmethod
   def _open_zip(cls, transform_id, stream_reader):
     try:
-      return zipfile.ZipFile(stream_reader)
-    except (AttributeError, blobstore.Error), e:
+      zipped_bundle = zipfile.ZipFile(stream_reader)
+    except (AttributeError, x5_exceptions.X5StorageError), e:
       # Having no blob raises AttributeError.
       raise x5_exceptions.X5BundleError(
           'Error opening blob for bundle key %s: %s', transform_id, e
@@ -218,22 +467,23 @@ class X5Bundle(object):
       raise x5_exceptions.X5BundleError(
           'Error opening zip from bundle key %s: %s' % (transform_id, e)
       )
+    if isinstance(stream_reader, x5_reader.X5RangeReader):
+      # Kept for opening the zip again on the same reader, as done to
+      # optimize images after the transform.
+      stream_reader.pin(zipped_bundle.start_dir, stream_reader.size)
+    return zipped_bundle
 
   @classmethod
   def zip_factory(cls, transform_id, stream_reader):
     """Returns an X5 bundle instance from a zipped bundle."""
     zipped_bundle = cls._open_zip(transform_id, stream_reader)
     bundle = cls(transform_id)
-    for info in zipped_bundle.infolist():
-      if info.filename.endswith('/'):
-        continue
-      if '__MACOSX/' in info.filename:
-        continue
-      basename = os.path.basename(info.filename)
-      if basename.startswith('.') or basename in ('Thumbs.db',):
-        continue
-      if info.filename.endswith('.DS_Store'):
-        continue
+    infos = [
+        info for info in zipped_bundle.infolist()
+        if not skipped_member(info.filename)
+    ]
+    x5_reader.plan_members(stream_reader, zipped_bundle, infos)
+    for info in infos:
       try:
         with zipped_bundle.open(info) as fileobj:
           bundle.add_member(info.filename, info.file_size, fileobj)
@@ -251,9 +501,34 @@ class X5Bundle(object):
     self.snippets = {}
     self.assets = {}
     self._macro_names = {}
+    # Assets and regexp for asset names, by root.
+    self._relative_assets = {}
+    # Inlineable assets whose references have been resolved.
+    self._resolved = set()
 
-  def get_creative_part(self, transform_id, stream_reader, snippet_name):
-    """Get snippet and assets in the format expected by the DFP API."""
+  @property
+  def memory_size(self):
+    """Approximate size in bytes of the snippets and assets in memory."""
+    return sum(r.memory_size for r in self.snippets.values()) + sum(
+        r.memory_size for r in self.assets.values()
+    )
+
+  def get_creative_part(self, transform_id, stream_reader, snippet_name,
+                        max_size=None, hashes=None):
+    """Get snippet and assets in the format expected by the DFP API.
+
+    Args:
+      transform_id: the transform id, used in asset file names.
+      stream_reader: file object for the zipped bundle.
+      snippet_name: name of the snippet, as present in the zip manifest.
+      max_size: optional (width, height) of the creative, images still over
+          the size limit are downscaled to it if needed.
+      hashes: optional dict where the MD5 of each uploaded asset content is
+          stored by macro name.
+
+    Returns:
+      A dictionary with the htmlSnippet and customCreativeAssets fields.
+    """
     if isinstance(snippet_name, unicode):
       snippet_name = snippet_name.encode('utf-8', errors='ignore')
     try:
@@ -262,21 +537,100 @@ class X5Bundle(object):
       raise x5_exceptions.X5BundleError(
           'Invalid snippet name or bundle not populated'
       )
-    zipped_bundle = self._open_zip(transform_id, stream_reader)
     # TODO(ludomagno): inject the assets table in the snippet
     creative_part = {
         'customCreativeAssets': [],
         'htmlSnippet': snippet.as_snippet()
     }
-    for asset_name in set(snippet.assets):
+    asset_names = self._uploaded_assets(snippet, creative_part['htmlSnippet'])
+    zipped_bundle = self._open_members(transform_id, stream_reader, [
+        name for name in asset_names if self.assets[name].from_zip or (
+            max_size and self.assets[name].over_limit and
+            self.assets[name].optimizable
+        )
+    ])
+    for asset_name in asset_names:
       # Don't skip assets that are over quota as they are referenced in macros.
       asset = self.assets[asset_name]
+      content = None
+      if max_size and asset.over_limit and asset.optimizable:
+        # Downscaling depends on the creative size, don't store the result.
+        with zipped_bundle.open(asset_name) as fileobj:
+          optimized = asset.optimize(fileobj, max_size)
+        if optimized:
+          content, method = optimized
+          logger.info('Asset %s optimized with %s for size %sx%s',
+                      asset_name, method, max_size[0], max_size[1])
+      if content is not None or not asset.from_zip:
+        # Content is in memory, combined assets are not even in the zip.
+        creative_part['customCreativeAssets'].append(asset.as_creative_asset(
+            transform_id, None, content, hashes
+        ))
+        continue
       with zipped_bundle.open(asset_name) as fileobj:
         creative_part['customCreativeAssets'].append(asset.as_creative_asset(
-            transform_id, fileobj
+            transform_id, fileobj, hashes=hashes
         ))
     return creative_part
 
+  def _uploaded_assets(self, snippet, html_snippet):
+    """Returns the names of the snippet assets referenced by a macro.
+
+    Assets inlined as data URIs are left out, unless the snippet or another uploaded asset still references them by macro, as
+    happens when some files inline them and others cannot.
+    """
+    uploaded = set(snippet.assets)
+    skipped = uploaded & set(snippet.data_uris)
+    uploaded -= skipped
+    texts = [html_snippet] + [self._asset_text(name) for name in uploaded]
+    while skipped:
+      kept = set(name for name in skipped if any(
+          '%%%%FILE:%s%%%%' % self.assets[name].id in t or
+          '__x5__.macro_%s' % self.assets[name].id in t for t in texts
+      ))
+      if not kept:
+        break
+      uploaded |= kept
+      skipped -= kept
+      texts = [self._asset_text(name) for name in kept]
+    return uploaded
+
+  def _asset_text(self, name):
+    asset = self.assets[name]
+    return asset.parsed_content or asset.content or ''
+
+  def _open_members(self, transform_id, stream_reader, names):
+    """Opens the zip to read the named members, or returns None if none."""
+    if not names:
+      return None
+    zipped_bundle = self._open_zip(transform_id, stream_reader)
+    x5_reader.plan_members(stream_reader, zipped_bundle, names)
+    return zipped_bundle
+
+  def optimize_assets(self, transform_id, stream_reader):
+    """Recompresses image assets over the size limit so that they fit."""
+    assets = [
+        asset for asset in self.assets.values()
+        if asset.over_limit and asset.optimizable
+    ]
+    zipped_bundle = self._open_members(
+        transform_id, stream_reader, [asset.name for asset in assets]
+    )
+    for asset in assets:
+      with zipped_bundle.open(asset.name) as fileobj:
+        optimized = asset.optimize(fileobj)
+      if not optimized:
+        continue
+      asset.optimized_content, asset.optimization = optimized
+      asset.size = len(asset.optimized_content)
+      logger.info('Asset %s optimized with %s, %s bytes saved', asset.name,
+                  asset.optimization, asset.original_size - asset.size)
+
+  def _next_id(self, ext):
+    """Returns a new macro id for an extension."""
+    self._macro_names[ext] = self._macro_names.get(ext, 0) + 1
+    return '%s%s' % (ext, self._macro_names[ext])
+
   def add_member(self, filename, filesize, fileobj):
     """Add a file to this bundle."""
     if isinstance(filename, unicode):
@@ -288,14 +642,79 @@ class X5Bundle(object):
     ext = (os.path.splitext(filename)[1] or '.noext').upper()[1:]
     if ext == 'NOEXT':
       return
-    self._macro_names[ext] = self._macro_names.get(ext, 0) + 1
-    obj_id = '%s%s' % (ext, self._macro_names[ext])
+    obj_id = self._next_id(ext)
     if mimetype in _SNIPPET_MIMETYPES:
       obj = X5Snippet(obj_id, filename, filesize, mimetype, fileobj)
       self.snippets[obj.name] = obj
     else:
       obj = X5Asset(obj_id, filename, filesize, mimetype, fileobj)
-      self.assets[obj.name] = obj
+      self.add_asset(obj)
+
+  def add_asset(self, asset):
+    self.assets[asset.name] = asset
+    self._relative_assets = {}
+
+  def remove_asset(self, name):
+    del self.assets[name]
+    self._relative_assets = {}
+
+  def relative_assets(self, root, exclude=()):
+    """Returns assets by name relative to root and a regexp matching them.
+
+    Both are built once per root and reused for every resource there.
+
+    Args:
+      root: the root the names are relative to.
+      exclude: names to leave out, in which case nothing is cached.
+
+    Returns:
+      An (assets, regexp) tuple.
+    """
+    if not exclude and root in self._relative_assets:
+      return self._relative_assets[root]
+    assets = self.assets_relative_to(root)
+    for name in exclude:
+      assets.pop(name, None)
+    value = (assets, x5_utils.tokens_regexp_quoted(assets.keys()))
+    if not exclude:
+      self._relative_assets[root] = value
+    return value
+
+  def dependencies(self, names, convert):
+    """Returns the inlineable assets reachable from names.
+
+    The graph is walked breadth first with a worklist. Each inlineable asset
+    not yet converted is converted once with convert, which populates its
+    own references; those are the edges followed from it.
+
+    Args:
+      names: the asset names referenced directly.
+      convert: function converting an inlineable asset in place.
+
+    Returns:
+      The list of reachable inlineable assets, each once.
+    """
+    reached = []
+    seen = set()
+    worklist = collections.deque()
+    for name in names:
+      if name not in seen:
+        seen.add(name)
+        worklist.append(name)
+    while worklist:
+      asset = self.assets[worklist.popleft()]
+      if not asset.inlineable:
+        continue
+      if asset.name not in self._resolved:
+        if not asset.converted:
+          convert(asset)
+        self._resolved.add(asset.name)
+      reached.append(asset)
+      for name in asset.assets:
+        if name not in seen:
+          seen.add(name)
+          worklist.append(name)
+    return reached
 
   def assets_relative_to(self, root):
     """Return assets dict with keys relative to root."""
@@ -334,6 +753,119 @@ class X5Bundle(object):
         else:
           snippet.x5type = converter.X5_TYPE
           break
+      if env.MINIFY:
+        snippet.minify()
+        for asset_name in set(snippet.assets):
+          self.assets[asset_name].minify()
+      if env.CONCAT_ASSETS:
+        self.concat_assets(snippet)
+      # Build the API fragment now, so submissions don't parse it again.
+      snippet.html_snippet  # pylint: disable=pointless-statement
+
+  def _concat_candidate(self, tag, assets_by_id):
+    """Returns (tag name, asset) if the asset loaded by tag can be merged."""
+    parsed = concat_tag(tag)
+    if not parsed:
+      return None
+    name, asset_id = parsed
+    asset = assets_by_id.get(asset_id)
+    if (asset is None or asset.mimetype not in _CONCAT_MIMETYPES[name] or
+        asset.over_limit or asset.combined_from):
+      return None
+    content = asset.parsed_content or asset.content
+    if not content or _CONCAT_UNSAFE_REGEXP.search(content):
+      return None
+    return name, asset
+
+  def _add_combined_asset(self, snippet, name, members):
+    """Creates and returns an asset joining the content of members."""
+    data = _CONCAT_SEPARATORS[name].join(
+        m.parsed_content or m.content for m in members
+    )
+    ext, mimetype = (
+        ('JS', 'application/javascript') if name == 'script' else
+        ('CSS', 'text/css')
+    )
+    obj_id = self._next_id(ext)
+    filename = os.path.join(
+        snippet.root, 'x5-combined-%s.%s' % (obj_id, ext.lower())
+    )
+    asset = X5Asset(obj_id, filename, len(data), mimetype, io.BytesIO(data))
+    asset.parsed_content = data
+    asset.combined_from = [m.name for m in members]
+    for m in members:
+      asset.assets += m.assets
+      asset.data_uris += m.data_uris
+    self.add_asset(asset)
+    return asset
+
+  def concat_assets(self, snippet):
+    """Merges runs of script or stylesheet tags into combined assets.
+
+    Consecutive tags of the same kind, only separated by whitespace, that
+    load converted assets by macro are replaced with a single tag loading an
+    asset with their content joined in the same order, up to the asset size
+    limit. Tags with attributes that affect loading (async, defer, media...)
+    and files with directives only valid at their start are left alone.
+
+    Args:
+      snippet: the converted snippet, rewritten in place.
+    """
+    content = snippet.parsed_content
+    if not content:
+      return
+    assets_by_id = dict((a.id, a) for a in self.assets.values())
+    runs = []
+    run = None
+    for m in _CONCAT_TAG_REGEXP.finditer(content):
+      candidate = self._concat_candidate(m.group(0), assets_by_id)
+      if candidate:
+        name, asset = candidate
+        size = len(asset.parsed_content or asset.content)
+        size += len(_CONCAT_SEPARATORS[name])
+      if candidate and run and run['name'] == name and (
+          not content[run['end']:m.start()].strip() and
+          run['size'] + size <= env.ASSET_SIZE_LIMIT):
+        run['members'].append(asset)
+        run['size'] += size
+        run['end'] = m.end()
+        continue
+      if run and len(run['members']) > 1:
+        runs.append(run)
+      run = candidate and {
+          'name': name, 'members': [asset], 'size': size,
+          'start': m.start(), 'end': m.end()
+      }
+    if run and len(run['members']) > 1:
+      runs.append(run)
+    if not runs:
+      return
+    parts = []
+    pos = 0
+    combined = []
+    for run in runs:
+      asset = self._add_combined_asset(snippet, run['name'], run['members'])
+      combined.append(asset)
+      parts.append(content[pos:run['start']])
+      parts.append(_CONCAT_TEMPLATES[run['name']] % asset.id)
+      pos = run['end']
+      logger.info('Combined %s into %s', asset.combined_from, asset.name)
+    parts.append(content[pos:])
+    snippet.parsed_content = ''.join(parts)
+    # Members may still be referenced elsewhere, e.g. from another asset.
+    members = set(m.name for run in runs for m in run['members'])
+    texts = [snippet.parsed_content] + [
+        a.parsed_content or a.content or '' for a in combined
+    ] + [
+        self.assets[a].parsed_content or self.assets[a].content or ''
+        for a in set(snippet.assets) if a not in members
+    ]
+    unreferenced = set(
+        a for a in members
+        if not any('%%%%FILE:%s%%%%' % self.assets[a].id in t for t in texts)
+    )
+    snippet.assets = [a for a in snippet.assets if a not in unreferenced]
+    snippet.assets += [a.name for a in combined]
 
   def _assets_table(self, snippet_name):
     """Returns an ASCII table of assets mappings."""
@@ -0,0 +1,245 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Retention based cleanup of uploaded bundles and transforms."""
+
+import collections
+import datetime
+import logging
+import time
+
+import env
+import x5_transform
+
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+
+logger = logging.getLogger('x5.cleanup')
+
+_BATCH_SIZE = 500
+# Time after which a cleanup task chains a new one, well within task deadlines.
+_TASK_BUDGET_SECONDS = 60
+
+
+class X5CleanupStats(object):
+  """Counters for a cleanup run."""
+
+  def __init__(self, transforms=0, blobs=0, seconds=0.0):
+    self.transforms = transforms
+    self.blobs = blobs
+    self.seconds = seconds
+
+  @property
+  def rate(self):
+    """Deleted transforms per second."""
+    return self.transforms / self.seconds if self.seconds else 0.0
+
+  def as_dict(self):
+    return {
+        'transforms': self.transforms, 'blobs': self.blobs,
+        'seconds': round(self.seconds, 3), 'rate': round(self.rate, 1)
+    }
+
+
+class X5TransformStore(object):
+  """Datastore access for the cleanup, replaced by stand-ins in tests."""
+
+  model = x5_transform.X5Transform
+
+  def expired_page(self, cutoff, unsubmitted_only, batch_size, cursor=None):
+    """Returns a page of transforms created before cutoff.
+
+    Args:
+      cutoff: the creation time before which transforms expire.
+      unsubmitted_only: whether to only select transforms never submitted.
+      batch_size: the page size.
+      cursor: an optional urlsafe cursor from the previous page.
+
+    Returns:
+      A (transforms, cursor, more) tuple, cursor being a urlsafe string.
+    """
+    model = self.model
+    filters = [model.created < cutoff]
+    if unsubmitted_only:
+      # pylint: disable=singleton-comparison
+      filters.append(model.creative_id == None)
+    transforms, cursor, more = model.query(*filters).fetch_page(
+        batch_size,
+        start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None
+    )
+    return transforms, cursor.urlsafe() if more and cursor else None, more
+
+  def blob_references(self, counts):
+    """Returns the keys of transforms referencing each blob.
+
+    Args:
+      counts: dict of blob keys to the number of known references, one more
+          key than that is enough to tell if other transforms use the blob.
+
+    Returns:
+      A dict of sets of transform keys by blob key.
+    """
+    model = self.model
+    futures = [
+        (blob_key, model.query(model.blob_key == blob_key).fetch_async(
+            count + 1, keys_only=True
+        )) for blob_key, count in counts.items()
+    ]
+    return dict(
+        (blob_key, set(future.get_result())) for blob_key, future in futures
+    )
+
+  def delete(self, transforms):
+    """Deletes transforms and their submitted creatives index entries."""
+    keys = [t.key for t in transforms]
+    submitted = [t for t in transforms if t.creative_id]
+    if submitted:
+      index_keys = [
+          x5_transform.X5SubmittedCreative.key_for(t) for t in submitted
+      ]
+      transform_keys = set(t.key for t in submitted)
+      keys += [
+          entry.key for entry in ndb.get_multi(index_keys)
+          if entry is not None and entry.transform_key in transform_keys
+      ]
+    ndb.delete_multi(keys)
+
+
+class X5Cleanup(object):
+  """Deletes expired transforms and their blobs in batches.
+
+  Transforms never submitted to DFP expire after the retention period.
+  Submitted ones are kept for the submitted retention period, or forever if
+  that is not set. Blobs are deleted from the storage of their transforms,
+  before the transforms so that a failed deletion is retried by the next
+  run. The datastore access and the blob deletion function can be replaced,
+  so the job can run against local stand-ins.
+  """
+
+  def __init__(self, retention, submitted_retention=None, now=None,
+               batch_size=_BATCH_SIZE, store=None, delete_blobs=None):
+    now = now or datetime.datetime.utcnow()
+    self.cutoff = now - retention
+    self.submitted_cutoff = (
+        now - submitted_retention if submitted_retention else None
+    )
+    self.batch_size = batch_size
+    self.store = store or X5TransformStore()
+    self.delete_blobs = delete_blobs
+
+  @property
+  def phases(self):
+    """Returns the (cutoff, unsubmitted_only) selections to expire, in order."""
+    phases = [(self.cutoff, True)]
+    if self.submitted_cutoff:
+      phases.append((self.submitted_cutoff, False))
+    return phases
+
+  def unreferenced_blobs(self, transforms):
+    """Returns the blob keys of transforms not used by any other transform.
+
+    Byte-identical uploads share one blob, which must be kept until the last
+    transform referencing it is deleted.
+    """
+    deleted = set(t.key for t in transforms)
+    counts = collections.Counter(t.blob_key for t in transforms if t.blob_key)
+    references = self.store.blob_references(counts)
+    return [
+        blob_key for blob_key in counts
+        if references.get(blob_key, set()) <= deleted
+    ]
+
+  def _delete_blobs(self, transforms, blob_keys):
+    """Deletes blobs with delete_blobs, or from each transform storage."""
+    if self.delete_blobs:
+      self.delete_blobs(blob_keys)
+      return
+    storages = dict((t.blob_key, t.storage) for t in transforms)
+    by_storage = collections.defaultdict(list)
+    for blob_key in blob_keys:
+      by_storage[storages[blob_key]].append(blob_key)
+    for storage, storage_keys in by_storage.items():
+      storage.delete(storage_keys)
+
+  def delete_batch(self, phase, cursor=None):
+    """Deletes one batch of expired transforms.
+
+    Args:
+      phase: the index of the selection in phases.
+      cursor: an optional urlsafe cursor from the previous batch.
+
+    Returns:
+      A (stats, cursor, more) tuple, cursor being a urlsafe string.
+    """
+    start = time.time()
+    cutoff, unsubmitted_only = self.phases[phase]
+    transforms, cursor, more = self.store.expired_page(
+        cutoff, unsubmitted_only, self.batch_size, cursor
+    )
+    blob_keys = self.unreferenced_blobs(transforms)
+    if blob_keys:
+      self._delete_blobs(transforms, blob_keys)
+    self.store.delete(transforms)
+    stats = X5CleanupStats(
+        len(transforms), len(blob_keys), time.time() - start
+    )
+    return stats, cursor, more
+
+  def run(self, phase=0, cursor=None, budget=_TASK_BUDGET_SECONDS):
+    """Deletes batches until done or over budget.
+
+    Returns:
+      A (stats, phase, cursor) tuple; phase is None when the run is complete,
+      otherwise phase and cursor are where the next run should resume.
+    """
+    stats = X5CleanupStats()
+    start = time.time()
+    while phase < len(self.phases):
+      batch, cursor, more = self.delete_batch(phase, cursor)
+      stats.transforms += batch.transforms
+      stats.blobs += batch.blobs
+      stats.seconds = time.time() - start
+      if not more:
+        phase, cursor = phase + 1, None
+      if stats.seconds > budget:
+        break
+    else:
+      phase = None
+    return stats, phase, cursor
+
+
+def from_env(now=None):
+  """Returns a cleanup instance configured from the environment."""
+  return X5Cleanup(
+      datetime.timedelta(hours=env.TRANSFORM_RETENTION_HOURS),
+      datetime.timedelta(days=env.SUBMITTED_RETENTION_DAYS),
+      now=now
+  )
+
+
+def run_cleanup(now=None, phase=0, cursor=None, totals=None):
+  """Deferred task running the cleanup, chaining itself until complete."""
+  now = now or datetime.datetime.utcnow()
+  stats, phase, cursor = from_env(now).run(phase, cursor)
+  totals = totals or X5CleanupStats()
+  totals.transforms += stats.transforms
+  totals.blobs += stats.blobs
+  totals.seconds += stats.seconds
+  logger.info('Cleanup batch: %s', stats.as_dict())
+  if phase is not None:
+    deferred.defer(run_cleanup, now, phase, cursor, totals)
+  else:
+    logger.info('Cleanup complete: %s', totals.as_dict())
+  return totals
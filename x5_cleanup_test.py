@@ -0,0 +1,144 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+"""Tests for the retention cleanup, against in-memory stand-ins."""
+
+import collections
+import datetime
+import unittest
+
+import x5_cleanup
+
+
+_NOW = datetime.datetime(2018, 6, 1)
+
+_Transform = collections.namedtuple(
+    '_Transform', 'key blob_key creative_id created'
+)
+
+
+class _MemoryStore(object):
+  """Transforms in a list, with integer offsets as cursors."""
+
+  def __init__(self, transforms):
+    self.transforms = list(transforms)
+
+  def expired_page(self, cutoff, unsubmitted_only, batch_size, cursor=None):
+    selected = [
+        t for t in self.transforms if t.created < cutoff and not (
+            unsubmitted_only and t.creative_id
+        )
+    ]
+    # Deleted transforms drop out of the selection, as in the datastore.
+    page = selected[:batch_size]
+    more = len(selected) > batch_size
+    return page, 'cursor' if more else None, more
+
+  def blob_references(self, counts):
+    return dict((blob_key, set(
+        t.key for t in self.transforms if t.blob_key == blob_key
+    )) for blob_key in counts)
+
+  def delete(self, transforms):
+    keys = set(t.key for t in transforms)
+    self.transforms = [t for t in self.transforms if t.key not in keys]
+
+
+def _transform(key, blob_key, creative_id=None, hours=0, days=0):
+  return _Transform(
+      key, blob_key, creative_id,
+      _NOW - datetime.timedelta(hours=hours, days=days)
+  )
+
+
+class X5CleanupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.deleted_blobs = []
+    self.store = _MemoryStore([
+        _transform('new', 'blob-new', hours=1),
+        _transform('old', 'blob-old', hours=48),
+        _transform('shared-old', 'blob-shared', hours=48),
+        _transform('shared-new', 'blob-shared', hours=1),
+        _transform('submitted', 'blob-submitted', creative_id=1, hours=48),
+        _transform('submitted-old', 'blob-submitted-old', creative_id=2,
+                   days=60),
+    ])
+
+  def _cleanup(self, submitted_retention=None, batch_size=100):
+    return x5_cleanup.X5Cleanup(
+        datetime.timedelta(hours=24), submitted_retention, now=_NOW,
+        batch_size=batch_size, store=self.store,
+        delete_blobs=self.deleted_blobs.extend
+    )
+
+  def _remaining(self):
+    return sorted(t.key for t in self.store.transforms)
+
+  def test_unsubmitted_expired(self):
+    stats, phase, _ = self._cleanup().run()
+    self.assertIsNone(phase)
+    self.assertEqual(
+        self._remaining(),
+        ['new', 'shared-new', 'submitted', 'submitted-old']
+    )
+    self.assertEqual(stats.transforms, 2)
+    self.assertEqual(self.deleted_blobs, ['blob-old'])
+
+  def test_submitted_retention(self):
+    stats, _, _ = self._cleanup(datetime.timedelta(days=30)).run()
+    self.assertEqual(
+        self._remaining(), ['new', 'shared-new', 'submitted']
+    )
+    self.assertEqual(stats.transforms, 3)
+    self.assertEqual(stats.blobs, 2)
+    self.assertIn('blob-submitted-old', self.deleted_blobs)
+
+  def test_shared_blob_deleted_with_last_transform(self):
+    self._cleanup().run()
+    self.assertNotIn('blob-shared', self.deleted_blobs)
+    cleanup = x5_cleanup.X5Cleanup(
+        datetime.timedelta(hours=0), now=_NOW, store=self.store,
+        delete_blobs=self.deleted_blobs.extend
+    )
+    cleanup.run()
+    self.assertIn('blob-shared', self.deleted_blobs)
+
+  def test_batches(self):
+    stats, phase, _ = self._cleanup(batch_size=1).run()
+    self.assertIsNone(phase)
+    self.assertEqual(stats.transforms, 2)
+
+  def test_budget_resume(self):
+    cleanup = self._cleanup(datetime.timedelta(days=30), batch_size=1)
+    stats, phase, cursor = cleanup.run(budget=-1)
+    self.assertEqual((stats.transforms, phase, cursor), (1, 0, 'cursor'))
+    stats, phase, _ = cleanup.run(phase, cursor)
+    self.assertIsNone(phase)
+    self.assertEqual(stats.transforms, 2)
+
+  def test_failed_blob_delete_keeps_transforms(self):
+    def fail(blob_keys):
+      raise IOError('storage unavailable')
+    cleanup = x5_cleanup.X5Cleanup(
+        datetime.timedelta(hours=24), now=_NOW, store=self.store,
+        delete_blobs=fail
+    )
+    self.assertRaises(IOError, cleanup.run)
+    self.assertIn('old', self._remaining())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -21,7 +21,9 @@ import os
 import re
 import urllib
 
+import env
 import x5_exceptions
+import x5_jslex
 import x5_utils
 
 
@@ -29,6 +31,10 @@ logger = logging.getLogger('x5.converters')
 
 
 _ESCAPE_MODULO_OP = re.compile(r'([^%])%([acghinstu])')
+# Delimiters of asset names embedded in js strings, e.g. HTML attributes.
+_JS_EMBEDDED_SPLIT_REGEXP = re.compile(r'(\\?["\']|[()=\s])')
+# Strings with a URL scheme, never rewritten to asset references.
+_URL_SCHEME_REGEXP = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:')
 
 
 def escape_modulo_op(script_block):
@@ -41,6 +47,11 @@ class X5ConverterDefault(object):
 
   X5_TYPE = 'default'
 
+  _CLICKTAGS = [
+      'var clickTag="%%CLICK_URL_UNESC%%" + "%%DEST_URL_ESC%%";',
+      'var clickTarget="_blank";'
+  ]
+
   # pylint: disable=unused-argument
 
   @classmethod
@@ -53,24 +64,172 @@ class X5ConverterDefault(object):
   def __init__(self, bundle):
     self.bundle = bundle
 
-  def convert(self, snippet, append_assets_to=None, template=None):
-    return self._convert_default(snippet, append_assets_to, template)
+  def convert(self, snippet, template=None):
+    return self._convert_default(snippet, template)
 
-  def _convert_default(self, snippet, append_assets_to=None, template=None):
-    """Converts the snippet and its assets in place."""
-    assets = self.bundle.assets_relative_to(snippet.root)
-    regexp = x5_utils.tokens_regexp_quoted(assets.keys())
-    match_func = x5_utils.match_function(snippet, assets, template=template)
-    snippet.parsed_content = regexp.sub(match_func, snippet.content)
-    if append_assets_to:
-      append_assets_to.assets += snippet.assets
-    else:
-      # Find a way to keep snippet if we want to recurse.
-      for asset_name in snippet.assets:
-        asset = self.bundle.assets[asset_name]
-        if not asset.inlineable or asset.converted:
-          continue
-        self._convert_default(asset, append_assets_to=snippet)
+  def _js_assets(self, roots):
+    """Returns assets by name relative to each root, earlier roots first."""
+    assets = {}
+    for root in reversed(roots):
+      assets.update(self.bundle.assets_relative_to(root))
+    return assets
+
+  @staticmethod
+  def _js_asset(assets, name, exclude=None):
+    """Returns the asset for a name found in a js string, or None.
+
+    Only names exactly matching an asset relative to one of the roots the
+    assets were resolved against are rewritten, never absolute URLs.
+    """
+    if '%' in name:
+      name = urllib.unquote(name)
+    if (not name or name.startswith('/') or _URL_SCHEME_REGEXP.match(name) or
+        (exclude and name.endswith(exclude))):
+      return None
+    return assets.get(name)
+
+  def _js_string_references(self, js_asset, assets, token, exclude=None):
+    """Returns a js string token with asset references rewritten, or None.
+
+    A string that is an asset name becomes the x5 variable for the asset.
+    Names embedded in a string, as in '<img src=\\"name\\">', are spliced
+    out and concatenated with the variable in the string's own quotes.
+    """
+    quote, body = token[0], token[1:-1]
+    asset = self._js_asset(assets, body, exclude)
+    if asset:
+      js_asset.assets.append(asset.name)
+      return '__x5__.macro_%s' % asset.id
+    pieces = _JS_EMBEDDED_SPLIT_REGEXP.split(body)
+    changed = False
+    # Even items are text between delimiters, odd items the delimiters.
+    for i in range(0, len(pieces), 2):
+      asset = self._js_asset(assets, pieces[i], exclude)
+      if asset is None:
+        continue
+      changed = True
+      js_asset.assets.append(asset.name)
+      pieces[i] = '%s + __x5__.macro_%s + %s' % (quote, asset.id, quote)
+    if not changed:
+      return None
+    return '%s%s%s' % (quote, ''.join(pieces), quote)
+
+  def _rewrite_js_references(self, js_asset, assets, exclude=None):
+    """Returns the js content with asset references in strings rewritten.
+
+    String literals are found with the js lexer in a single pass, and only
+    those referencing an asset are rewritten. Scripts the lexer cannot
+    tokenize fall back to matching names with their quoting context.
+
+    Args:
+      js_asset: the js asset, whose content is rewritten and whose assets
+          collect the references found.
+      assets: dict of assets by name, as referenced from the js.
+      exclude: optional suffix of asset names to leave alone.
+
+    Returns:
+      The rewritten content.
+    """
+    content = js_asset.content
+    try:
+      strings = [
+          (start, end) for kind, start, end in x5_jslex.tokens(content)
+          if kind == 'string'
+      ]
+    except x5_jslex.JSLexError, e:
+      logger.warning('Cannot tokenize %s, matching names instead: %s',
+                     js_asset.name, e)
+      return self._js_match_regexp(assets, exclude).sub(
+          functools.partial(self._js_match_function, js_asset, assets),
+          content
+      )
+    parts = []
+    pos = 0
+    for start, end in strings:
+      replacement = self._js_string_references(
+          js_asset, assets, content[start:end], exclude
+      )
+      if replacement is None:
+        continue
+      parts.append(content[pos:start])
+      parts.append(replacement)
+      pos = end
+    parts.append(content[pos:])
+    return ''.join(parts)
+
+  @staticmethod
+  def _js_match_regexp(assets, exclude=None):
+    """Returns a regexp that matches asset names with quoting context."""
+    return x5_utils.tokens_regexp_quoted([
+        k for k in assets.keys() if not (exclude and k.endswith(exclude))
+    ], fmt=r'.{2}%s.{2}')
+
+  @staticmethod
+  def _js_match_function(snippet, assets, match):
+    """Returns a match function to replace asset names with x5 variables."""
+    name = match.group(1)
+    if '%' in name:
+      name = urllib.unquote(name)
+    try:
+      asset = assets[name[2:-2]]
+    except KeyError:
+      return match.group(1)
+    snippet.assets.append(asset.name)
+    if name.startswith(r'\"') or name.startswith(r"\'"):
+      # From this in js: '<a href=\"asset.name\">'
+      # To this:  '<a href=[\"' + ]__x5__.macro_ID[ + '\"]>'
+      return "' + __x5__.macro_%s + '" % asset.id
+    elif name[1] in ('"', "'"):
+      # From this js: var g23=['"]970x90.jpg['"],
+      # To this: var g23=__x5__.macro_ID,
+      return '%s__x5__.macro_%s%s' % (name[0], asset.id, name[-1])
+    return '%s__x5__.macro_%s%s' % (name[:2], asset.id, name[-2:])
+
+  def _js_macro_vars(self, js_asset, snippet):
+    """Associates the js asset's assets with the snippet and returns X5 vars.
+
+    Uploaded assets don't get macros expanded, so the js references assets
+    via __x5__ variables that the snippet sets from macros.
+    """
+    x5vars = []
+    names = set(js_asset.assets)
+    for asset_name in names:
+      asset = self.bundle.assets[asset_name]
+      snippet.assets.append(asset_name)
+      x5vars.append(
+          '__x5__.macro_%(id)s = "%%%%FILE:%(id)s%%%%";' % {'id': asset.id}
+      )
+    js_asset.assets = []
+    self._add_dependencies(snippet, names)
+    return x5vars
+
+  def _convert_resource(self, resource, template=None, exclude=()):
+    """Replaces asset references in a snippet or inlineable asset."""
+    assets, regexp = self.bundle.relative_assets(resource.root, exclude)
+    match_func = x5_utils.match_function(resource, assets, template=template)
+    resource.parsed_content = regexp.sub(match_func, resource.content)
+
+  def _add_dependencies(self, snippet, names):
+    """Adds the assets reachable from names to the snippet's assets.
+
+    Inlineable assets reached for the first time are converted, once per
+    bundle, so assets shared by several snippets are still associated with
+    each of them.
+    """
+    for asset in self.bundle.dependencies(names, self._convert_resource):
+      snippet.assets += asset.assets
+      snippet.data_uris += asset.data_uris
+
+  def _convert_default(self, snippet, template=None, exclude=()):
+    """Converts the snippet and its assets in place.
+
+    Args:
+      snippet: the snippet to convert.
+      template: optional replacement template for asset references.
+      exclude: asset names, relative to the snippet root, left unconverted.
+    """
+    self._convert_resource(snippet, template, exclude)
+    self._add_dependencies(snippet, snippet.assets)
 
 
 class X5ConverterEdge(X5ConverterDefault):
@@ -103,42 +262,10 @@ class X5ConverterEdge(X5ConverterDefault):
       r"(?P<post>', '[A-Za-z0-9_-]+', \{)"
   ))
   _PATHS_REGEXP = re.compile(r"\b(im|aud|vid|js)='([^']*?)/?'")
-  _CLICKTAGS = [
-      'var clickTag="%%CLICK_URL_UNESC%%" + "%%DEST_URL_ESC%%";',
-      'var clickTarget="_blank";'
-  ]
   _WINDOWOPEN_REGEXP = re.compile(
       r'''window\.open\(['"][^'"]*['"]((?:,[^\)]+)?)\)'''
   )
 
-  @staticmethod
-  def _edge_js_match_regexp(runtime, assets):
-    """Returns a regexp that matches asset names with quoting context."""
-    return x5_utils.tokens_regexp_quoted([
-        k for k in assets.keys() if not k.endswith(runtime)
-    ], fmt=r'.{2}%s.{2}')
-
-  @staticmethod
-  def _edge_js_match_function(snippet, assets, match):
-    """Returns a match function to replace asset names with x5 variables."""
-    name = match.group(1)
-    if '%' in name:
-      name = urllib.unquote(name)
-    try:
-      asset = assets[name[2:-2]]
-    except KeyError:
-      return match.group(1)
-    snippet.assets.append(asset.name)
-    if name.startswith(r'\"') or name.startswith(r"\'"):
-      # From this in edge js: '<a href=\"asset.name\">'
-      # To this:  '<a href=[\"' + ]__x5__.macro_ID[ + '\"]>'
-      return "' + __x5__.macro_%s + '" % asset.id
-    elif name[1] in ('"', "'"):
-      # From this edge js: var g23=['"]970x90.jpg['"],
-      # To this: var g23=__x5__.macro_ID,
-      return '%s__x5__.macro_%s%s' % (name[0], asset.id, name[-1])
-    return '%s__x5__.macro_%s%s' % (name[:2], asset.id, name[-2:])
-
   @classmethod
   def match(cls, snippet):
     """Checks if a bundle matches this type."""
@@ -178,11 +305,9 @@ class X5ConverterEdge(X5ConverterDefault):
     js_asset.content = self._PATHS_REGEXP.sub(
         r"\1=''", js_asset.content
     )
-    assets = self.bundle.assets_relative_to(paths)
-    assets_regexp = self._edge_js_match_regexp(runtime, assets)
-    js_asset.parsed_content = assets_regexp.sub(
-        functools.partial(self._edge_js_match_function, js_asset, assets),
-        js_asset.content
+    assets = self._js_assets(paths)
+    js_asset.parsed_content = self._rewrite_js_references(
+        js_asset, assets, runtime
     )
 
   def _fix_edge_clickurl(self, content):
@@ -191,21 +316,6 @@ class X5ConverterEdge(X5ConverterDefault):
         r'window.open(clickTag\1)', content
     )
 
-  def _fix_edge_js_assets(self, js_asset, snippet):
-    """Associates the Edge js assets with the snippet and returns X5 vars."""
-    x5vars = []
-    for asset_name in set(js_asset.assets):
-      asset = self.bundle.assets[asset_name]
-      snippet.assets.append(asset_name)
-      x5vars.append(
-          '__x5__.macro_%(id)s = "%%%%FILE:%(id)s%%%%";' % {'id': asset.id}
-      )
-      if not asset.inlineable:
-        continue
-      self._convert_default(asset, append_assets_to=snippet)
-    js_asset.assets = []
-    return x5vars
-
   def convert(self, snippet):
     """Converts the snippet and its assets in place."""
     content = snippet.content
@@ -223,7 +333,7 @@ class X5ConverterEdge(X5ConverterDefault):
     ]
     content_parts += self._CLICKTAGS
     content_parts.append('var __x5__ = {};')
-    content_parts += self._fix_edge_js_assets(js_asset, snippet)
+    content_parts += self._js_macro_vars(js_asset, snippet)
     content_parts.append('// end x5 injected variables\n')
     content_parts.append('// Firefox and IE rendering latency remover\n')
     content_parts.append('AdobeEdge.yepnope.errorTimeout = 5e2;\n\n')
@@ -251,7 +361,7 @@ class X5ConverterHype(X5ConverterDefault):
       r'([^"\']+_hype_generated_script.js)(?:\?[0-9]+)?'
       r'["\'][^>]*/?>(?:\s*</script>)?'
   ))
-  _FOLDER_VAR_REGEXP = re.compile(r'var f\s*=\s*"[^"]+",')
+  _FOLDER_VAR_REGEXP = re.compile(r'var f\s*=\s*"([^"]+)",')
   # pylint: disable=line-too-long
   _DOMAIN_FIX_SCRIPT = (
       "var hypeElementContainer = '%s_hype_container';\n"
@@ -283,17 +393,26 @@ class X5ConverterHype(X5ConverterDefault):
 
   def convert(self, snippet):
     content = snippet.content
-    tag_start, tag_end, asset_name = self._parse_hype_script_tag(content)
-    asset_name = os.path.basename(asset_name)
-    if asset_name not in self.bundle.assets:
+    tag_start, tag_end, src = self._parse_hype_script_tag(content)
+    asset_name = os.path.basename(src)
+    # The script is usually in the resources folder next to the snippet.
+    hype_asset = self.bundle.assets_relative_to(snippet.root).get(
+        urllib.unquote(src), self.bundle.assets.get(asset_name)
+    )
+    if hype_asset is None:
       raise x5_exceptions.X5ConverterError(
           'Hype script %s not found.', asset_name
       )
-    hype_content = self.bundle.assets[asset_name].content
-    hype_content = self._FOLDER_VAR_REGEXP.sub('var f="",', hype_content)
     domain_fix_script = self._DOMAIN_FIX_SCRIPT % asset_name.replace(
         '_hype_generated_script.js', ''
     )
+    if env.HYPE_EXTERNAL_SCRIPT:
+      return self._convert_external(
+          snippet, content[:tag_start], content[tag_end:], hype_asset,
+          domain_fix_script
+      )
+    hype_content = hype_asset.content
+    hype_content = self._FOLDER_VAR_REGEXP.sub('var f="",', hype_content)
     content = content[:tag_start] + content[tag_end:]
     content = content.replace(
         '</body>',
@@ -302,8 +421,128 @@ class X5ConverterHype(X5ConverterDefault):
         )
     )
     snippet.content = content
-    del self.bundle.assets[asset_name]
+    self.bundle.remove_asset(hype_asset.name)
     return self._convert_default(snippet)
 
+  def _convert_external(self, snippet, head, tail, hype_asset,
+                        domain_fix_script):
+    """Converts the snippet keeping the generated script as an asset.
+
+    Only the generated script's own asset references are rewritten, to x5
+    variables set by the snippet, and the snippet loads it via its macro.
+    """
+    folder = self._FOLDER_VAR_REGEXP.search(hype_asset.content)
+    hype_asset.content = self._FOLDER_VAR_REGEXP.sub(
+        'var f="",', hype_asset.content
+    )
+    paths = [snippet.root]
+    if folder:
+      folder = urllib.unquote(folder.group(1))
+      paths.insert(0, os.path.join(snippet.root, folder))
+    assets = self._js_assets(paths)
+    hype_asset.parsed_content = self._rewrite_js_references(
+        hype_asset, assets, hype_asset.basename
+    )
+    x5vars = self._js_macro_vars(hype_asset, snippet)
+    snippet.assets.append(hype_asset.name)
+    script = (
+        '<script>\nvar __x5__ = {};\n%s\n</script>\n'
+        '<script src="%%%%FILE:%s%%%%"></script>'
+    ) % ('\n'.join(x5vars), hype_asset.id)
+    snippet.content = (head + script + tail).replace(
+        '</body>', '<script>\n%s\n</script>\n</body>' % domain_fix_script
+    )
+    return self._convert_default(
+        snippet, exclude=[hype_asset.name_relative_to(snippet.root)]
+    )
+
+
+class X5ConverterGWD(X5ConverterDefault):
+  """Converter for Google Web Designer bundles."""
+
+  X5_TYPE = 'gwd'
+
+  _MATCH_REGEXP = re.compile(
+      r'<meta\s[^>]*content=["\']Google Web Designer|'
+      r'<script\s[^>]*data-exports-type=["\']gwd', re.I
+  )
+  _RUNTIME_REGEXP = re.compile(
+      r'<script\s[^>]*\bdata-exports-type=[^>]*>', re.I
+  )
+  _SRC_REGEXP = re.compile(r'''(\bsrc\s*=\s*)(["']?)[^"'\s>]+\2''', re.I)
+  # Studio exits, only meaningful when served by DoubleClick Studio.
+  _ENABLER_EXIT_REGEXP = re.compile(r'\bEnabler\.exit(?:Override)?\([^()]*\)')
+  # Generic ad exits, whose url argument is replaced with the click tag.
+  _GENERIC_EXIT_REGEXP = re.compile(
+      r'''(\bgwd\.actions\.gwdGenericad\.exit\(\s*'''
+      r'''(?:'[^']*'|"[^"]*"|[\w$.]+)\s*,\s*)(?:'[^']*'|"[^"]*")'''
+  )
+
+  @classmethod
+  def match(cls, snippet):
+    """Checks if a bundle matches this type."""
+    return cls._MATCH_REGEXP.search(snippet.content)
+
+  def _externalize_runtime(self, content, snippet_root):
+    """Points GWD runtime scripts to their hosted copies.
+
+    Returns:
+      A (content, names) tuple, names being the local runtime assets no
+      longer referenced, relative to the snippet root.
+    """
+    if not env.GWD_RUNTIME_URL:
+      return content, []
+    assets = self.bundle.assets_relative_to(snippet_root)
+    names = []
+    parts = []
+    pos = 0
+    for m in self._RUNTIME_REGEXP.finditer(content):
+      _, attrs = x5_utils.parse_start_tag(m.group(0))
+      src = urllib.unquote(attrs.get('src', ''))
+      if src not in assets:
+        continue
+      try:
+        url = env.GWD_RUNTIME_URL % {
+            'source': attrs.get('data-source') or os.path.basename(src),
+            'version': attrs.get('data-version', ''),
+            'type': attrs.get('data-exports-type', '')
+        }
+      except (KeyError, ValueError, TypeError), e:
+        raise x5_exceptions.X5ConverterError(
+            'Invalid GWD runtime URL template: %s' % e
+        )
+      parts.append(content[pos:m.start()])
+      parts.append(self._SRC_REGEXP.sub(
+          lambda src_match, url=url: '%s"%s"' % (src_match.group(1), url),
+          m.group(0), 1
+      ))
+      pos = m.end()
+      names.append(src)
+    parts.append(content[pos:])
+    return ''.join(parts), names
+
+  def _fix_gwd_exits(self, content):
+    """Replaces Studio and generic ad exits with the DFP click tag."""
+    content, studio = self._ENABLER_EXIT_REGEXP.subn(
+        'window.open(clickTag, clickTarget)', content
+    )
+    content, generic = self._GENERIC_EXIT_REGEXP.subn(r'\1clickTag', content)
+    if not (studio or generic):
+      return content
+    clicktags = '<script>\n%s\n</script>\n' % '\n'.join(self._CLICKTAGS)
+    for tag in ('</head>', '<body'):
+      i = content.find(tag)
+      if i != -1:
+        return content[:i] + clicktags + content[i:]
+    return clicktags + content
+
+  def convert(self, snippet):
+    """Converts the snippet and its assets in place."""
+    content, runtime = self._externalize_runtime(snippet.content, snippet.root)
+    snippet.content = self._fix_gwd_exits(content)
+    return self._convert_default(snippet, exclude=runtime)
+
 
-X5_CONVERTERS = [X5ConverterEdge, X5ConverterHype, X5ConverterDefault]
+X5_CONVERTERS = [
+    X5ConverterEdge, X5ConverterHype, X5ConverterGWD, X5ConverterDefault
+]
@@ -0,0 +1,126 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+"""Tests for the bundle converters."""
+
+import io
+import mimetypes
+import unittest
+import zipfile
+
+import x5_bundle
+
+
+_EDGE_SNIPPET = '''<html><head><!--Adobe Edge Runtime-->
+<script type="text/javascript" charset="utf-8"
+    src="edge_includes/edge.6.0.0.min.js"></script>
+<script>AdobeEdge.loadComposition('ad', 'EDGE-1', {scaleToFit: "none"},
+    {dom: {}}, {dom: {}});</script>
+<!--Adobe Edge Runtime End--></head><body></body></html>'''
+
+_EDGE_JS = r'''(function($,Edge,compId){var im='images/',aud='media/',
+vid='media/',js='js/',fonts={},opts={},resources=[],scripts=[],symbols={
+"stage":{content:{dom:[
+{id:'a',type:'image',fill:["rgba(0,0,0,0)",im+"a.png",'0px','0px']},
+{id:'t',type:'text',text:'<img src=\"images/b.png\">'},
+{id:'u',type:'text',text:'<img src=\"https://cdn.example.com/x/a.png\">'},
+{id:'o',type:'image',fill:["rgba(0,0,0,0)","other/a.png",'0px','0px']}]}}};
+Edge.registerCompositionDefn(compId,symbols,fonts,scripts,resources,opts);
+})("AdobeEdge.$","AdobeEdge","EDGE-1");'''
+
+_GWD_SNIPPET = '''<!DOCTYPE html><html><head>
+<SCRIPT DATA-SOURCE="gwdpage_min.js" DATA-VERSION="9"
+    DATA-EXPORTS-TYPE="gwd-page" SRC="gwdpage_min.js"></SCRIPT>
+</head><body><img src="a.png"></body></html>'''
+
+
+def setUpModule():
+  # Not registered by every platform's mime.types.
+  mimetypes.add_type('application/javascript', '.js')
+
+
+def _bundle(files):
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, 'w') as z:
+    for name, content in files:
+      z.writestr(name, content)
+  bundle = x5_bundle.X5Bundle.zip_factory('test', buf)
+  bundle.transform()
+  return bundle
+
+
+class X5ConverterEdgeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.bundle = _bundle([
+        ('ad.html', _EDGE_SNIPPET),
+        ('ad_edge.js', _EDGE_JS),
+        ('images/a.png', '\x89PNG a'),
+        ('images/b.png', '\x89PNG b'),
+        ('edge_includes/edge.6.0.0.min.js', 'runtime'),
+    ])
+    self.snippet = self.bundle.snippets['ad.html']
+    self.js = self.bundle.assets['ad_edge.js'].parsed_content
+
+  def test_converted_as_edge(self):
+    self.assertEqual(self.snippet.x5type, 'edge')
+
+  def test_string_reference(self):
+    asset = self.bundle.assets['images/a.png']
+    self.assertIn('im+__x5__.macro_%s' % asset.id, self.js)
+    self.assertIn('images/a.png', self.snippet.assets)
+
+  def test_embedded_path_reference(self):
+    asset = self.bundle.assets['images/b.png']
+    self.assertIn(
+        r"""'<img src=\"' + __x5__.macro_%s + '\">'""" % asset.id, self.js
+    )
+    self.assertNotIn('images/b.png', self.js)
+    self.assertIn('images/b.png', self.snippet.assets)
+    self.assertIn(
+        '__x5__.macro_%(id)s = "%%%%FILE:%(id)s%%%%";' % {'id': asset.id},
+        self.snippet.parsed_content
+    )
+
+
+  def test_non_matching_references_kept(self):
+    self.assertIn('https://cdn.example.com/x/a.png', self.js)
+    self.assertIn('"other/a.png"', self.js)
+
+
+class X5ConverterGWDTest(unittest.TestCase):
+
+  def setUp(self):
+    self.bundle = _bundle([
+        ('ad.html', _GWD_SNIPPET),
+        ('gwdpage_min.js', 'runtime'),
+        ('a.png', '\x89PNG a'),
+    ])
+    self.snippet = self.bundle.snippets['ad.html']
+
+  def test_converted_as_gwd(self):
+    self.assertEqual(self.snippet.x5type, 'gwd')
+
+  def test_hosted_runtime(self):
+    self.assertIn(
+        'SRC="https://s0.2mdn.net/ads/studio/cached_libs/gwdpage_min.js"',
+        self.snippet.parsed_content
+    )
+    self.assertNotIn('gwdpage_min.js', self.snippet.assets)
+    self.assertIn('a.png', self.snippet.assets)
+
+
+if __name__ == '__main__':
+  unittest.main()
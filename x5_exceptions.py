@@ -34,3 +34,13 @@ class X5ConverterError(X5Error):
   """Errors raised when converting the zipped bundle."""
   pass
 
+
+
+class X5ZipError(X5BundleError):
+  """Errors raised when an uploaded file is not a usable zip archive."""
+  pass
+
+
+class X5StorageError(X5Error):
+  """Errors raised when reading or deleting stored bundles."""
+  pass
@@ -0,0 +1,113 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Recompression of image assets that exceed the DFP asset size limit."""
+
+import io
+import logging
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+
+logger = logging.getLogger('x5.images')
+
+
+OPTIMIZABLE_MIMETYPES = ('image/png', 'image/jpeg', 'image/gif')
+_FORMATS = {'image/png': 'PNG', 'image/jpeg': 'JPEG', 'image/gif': 'GIF'}
+# JPEG qualities tried in order, from visually lossless to acceptable.
+_JPEG_QUALITIES = (90, 85, 80, 75)
+
+
+def _save(img, fmt, **kwargs):
+  buf = io.BytesIO()
+  img.save(buf, fmt, **kwargs)
+  return buf.getvalue()
+
+
+def _encoders(img, fmt):
+  """Yields (method, function) pairs, from lossless to most lossy.
+
+  Saving without passing the source info drops metadata (EXIF, text chunks,
+  comments) in all formats.
+  """
+  if fmt == 'PNG':
+    yield 'png optimized', lambda im: _save(im, 'PNG', optimize=True)
+    if img.mode in ('RGB', 'L'):
+      yield 'png palette', lambda im: _save(
+          im.convert('P', palette=Image.ADAPTIVE), 'PNG', optimize=True
+      )
+  elif fmt == 'JPEG':
+    for quality in _JPEG_QUALITIES:
+      yield 'jpeg q%s' % quality, lambda im, q=quality: _save(
+          im, 'JPEG', quality=q, optimize=True
+      )
+  elif fmt == 'GIF':
+    yield 'gif optimized', lambda im: _save(im, 'GIF', optimize=True)
+
+
+def _is_animated(img):
+  try:
+    img.seek(1)
+  except EOFError:
+    return False
+  img.seek(0)
+  return True
+
+
+def optimize(content, mimetype, limit, max_size=None):
+  """Recompresses an image so that it fits within limit bytes.
+
+  Encodings are tried from lossless to near lossless at the original
+  dimensions, then again after downscaling to max_size if given.
+
+  Args:
+    content: the image data.
+    mimetype: the image mimetype, one of OPTIMIZABLE_MIMETYPES.
+    limit: the maximum size in bytes for the result.
+    max_size: optional (width, height) the image can be downscaled to.
+
+  Returns:
+    A (data, method) tuple with the recompressed image and a description of
+    the method used, or None if the image could not be made to fit.
+  """
+  fmt = _FORMATS.get(mimetype)
+  if Image is None or fmt is None:
+    return None
+  try:
+    img = Image.open(io.BytesIO(content))
+    if fmt == 'GIF' and _is_animated(img):
+      # Saving would drop all frames but the first.
+      return None
+    img.load()
+  except (IOError, ValueError) as e:
+    logger.warning('Cannot open %s image: %s', mimetype, e)
+    return None
+  images = [(img, '')]
+  if max_size and (img.size[0] > max_size[0] or img.size[1] > max_size[1]):
+    scaled = img.copy()
+    scaled.thumbnail(max_size, Image.ANTIALIAS)
+    images.append((scaled, ' scaled to %sx%s' % scaled.size))
+  for im, scale in images:
+    for method, encoder in _encoders(im, fmt):
+      try:
+        data = encoder(im)
+      except (IOError, ValueError) as e:
+        logger.warning('Error encoding %s image: %s', mimetype, e)
+        continue
+      if len(data) <= limit:
+        return data, method + scale
+  return None
@@ -0,0 +1,170 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Minimal JavaScript lexer for string literals, comments and regexps.
+
+Only the tokens that can contain arbitrary text are recognized, in a single
+linear pass, so that code rewriting asset references or whitespace never
+looks inside them by mistake. Whether a '/' starts a regexp literal or is a
+division is decided from the previous significant token, which is right for
+all but contrived code.
+"""
+
+
+WHITESPACE = ' \t\n\r\f\v'
+# Characters after which a '/' starts a regexp literal rather than a division.
+_REGEXP_PRECEDERS = frozenset('(,=:[!&|?{};+-*%<>~^')
+_REGEXP_KEYWORDS = frozenset((
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+    'throw', 'case', 'do', 'else', 'yield', 'await'
+))
+
+
+class JSLexError(Exception):
+  """Raised when the source cannot be tokenized."""
+  pass
+
+
+def is_word(c):
+  """Checks if c can be part of an identifier, keyword or number."""
+  return c.isalnum() or c in '_$\\' or ord(c) > 127
+
+
+def skip_string(s, i):
+  """Returns the index after the string or template literal starting at i."""
+  quote = s[i]
+  i += 1
+  while i < len(s):
+    c = s[i]
+    if c == '\\':
+      i += 2
+      continue
+    if c == quote:
+      return i + 1
+    if c == '\n' and quote != '`':
+      break
+    if quote == '`' and s.startswith('${', i):
+      i = _skip_template_expression(s, i + 2)
+      continue
+    i += 1
+  raise JSLexError('Unterminated string at %s' % i)
+
+
+def _skip_template_expression(s, i):
+  """Returns the index after the '}' closing a template substitution."""
+  depth = 1
+  while i < len(s):
+    c = s[i]
+    if c in '\'"`':
+      i = skip_string(s, i)
+      continue
+    if c == '{':
+      depth += 1
+    elif c == '}':
+      depth -= 1
+      if not depth:
+        return i + 1
+    i += 1
+  raise JSLexError('Unterminated template substitution at %s' % i)
+
+
+def skip_regexp(s, i):
+  """Returns the index after the regexp literal (and flags) starting at i."""
+  i += 1
+  in_class = False
+  while i < len(s):
+    c = s[i]
+    if c == '\\':
+      i += 2
+      continue
+    if c == '\n':
+      break
+    if c == '[':
+      in_class = True
+    elif c == ']':
+      in_class = False
+    elif c == '/' and not in_class:
+      i += 1
+      while i < len(s) and is_word(s[i]):
+        i += 1
+      return i
+    i += 1
+  raise JSLexError('Unterminated regexp at %s' % i)
+
+
+def regexp_allowed(previous):
+  """Checks if a '/' after the previous significant token starts a regexp.
+
+  Args:
+    previous: the previous punctuator character or identifier, '' at start.
+
+  Returns:
+    True if a regexp literal can start here.
+  """
+  return (
+      not previous or previous in _REGEXP_PRECEDERS or
+      previous in _REGEXP_KEYWORDS
+  )
+
+
+def tokens(source):
+  """Yields (kind, start, end) for literals and comments in the source.
+
+  Args:
+    source: the script source.
+
+  Yields:
+    Tuples where kind is one of 'string', 'template', 'regexp' or 'comment',
+    and source[start:end] is the whole token including delimiters.
+
+  Raises:
+    JSLexError: if a literal or comment is not terminated.
+  """
+  i, n = 0, len(source)
+  previous = ''
+  while i < n:
+    c = source[i]
+    if c in WHITESPACE:
+      i += 1
+    elif source.startswith('//', i):
+      end = source.find('\n', i)
+      end = n if end == -1 else end
+      yield 'comment', i, end
+      i = end
+    elif source.startswith('/*', i):
+      end = source.find('*/', i + 2)
+      if end == -1:
+        raise JSLexError('Unterminated comment at %s' % i)
+      yield 'comment', i, end + 2
+      i = end + 2
+    elif c in '\'"`':
+      end = skip_string(source, i)
+      yield 'template' if c == '`' else 'string', i, end
+      previous = c
+      i = end
+    elif c == '/' and regexp_allowed(previous):
+      end = skip_regexp(source, i)
+      yield 'regexp', i, end
+      # A '/' following a regexp literal is a division.
+      previous = ')'
+      i = end
+    elif is_word(c):
+      end = i + 1
+      while end < n and is_word(source[end]):
+        end += 1
+      previous = source[i:end]
+      i = end
+    else:
+      previous = c
+      i += 1
@@ -0,0 +1,255 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Conservative minifiers for converted JS, CSS and HTML content.
+
+Minifiers only drop comments and collapse whitespace, never rename or
+reorder anything. String literals, regexp literals and CSS url() values are
+copied verbatim, so %%FILE:ID%% macros are never altered, and whitespace
+following a '%' is always kept so that escape_modulo_op's escaping survives.
+Comments starting with '/*!' (licenses) or '/*@' (conditional compilation)
+and HTML conditional comments are kept.
+"""
+
+import logging
+import re
+
+import x5_jslex
+import x5_utils
+
+
+logger = logging.getLogger('x5.minifiers')
+
+
+class MinifierError(x5_jslex.JSLexError):
+  """Raised when content cannot be tokenized safely."""
+  pass
+
+
+_WHITESPACE = x5_jslex.WHITESPACE
+# Whitespace next to these characters can go, unless the pair is unsafe.
+_JS_PUNCTUATORS = frozenset('{}()[];,:=<>?!&|*^~+-')
+_JS_UNSAFE_PAIRS = frozenset(('++', '--', '+-', '-+', '<!', '->', '</'))
+# A newline next to these can go without changing semicolon insertion.
+_JS_NEWLINE_BEFORE = frozenset('{;,')
+_JS_NEWLINE_AFTER = frozenset('}')
+
+
+def _kept_comment(comment):
+  return comment.startswith('/*!') or comment.startswith('/*@')
+
+
+def _regexp_allowed(out):
+  """Checks if a '/' following the output so far starts a regexp."""
+  j = len(out) - 1
+  while j >= 0 and out[j] in x5_jslex.WHITESPACE:
+    j -= 1
+  if j < 0 or not x5_jslex.is_word(out[j]):
+    return x5_jslex.regexp_allowed(out[j] if j >= 0 else '')
+  k = j
+  while k >= 0 and x5_jslex.is_word(out[k]):
+    k -= 1
+  return x5_jslex.regexp_allowed(out[k+1:j+1])
+
+
+def _js_space(prev, nxt, newline):
+  """Returns the whitespace to keep between prev and nxt characters."""
+  if not prev or not nxt:
+    return ''
+  if newline:
+    if prev in _JS_NEWLINE_BEFORE or nxt in _JS_NEWLINE_AFTER:
+      return ''
+    return '\n'
+  if prev == '%' or prev + nxt in _JS_UNSAFE_PAIRS:
+    return ' '
+  if prev in _JS_PUNCTUATORS or nxt in _JS_PUNCTUATORS:
+    return ''
+  return ' '
+
+
+def minify_js(content):
+  """Removes comments and redundant whitespace from a script."""
+  out = []
+  # Pending whitespace: None, or True if it contains a newline.
+  pending = None
+  i, n = 0, len(content)
+  while i < n:
+    c = content[i]
+    if c in _WHITESPACE:
+      pending = bool(pending) or c in '\n\r'
+      i += 1
+      continue
+    if c == '/' and content.startswith('//', i):
+      end = content.find('\n', i)
+      i = n if end == -1 else end
+      continue
+    if c == '/' and content.startswith('/*', i):
+      end = content.find('*/', i + 2)
+      if end == -1:
+        raise MinifierError('Unterminated comment at %s' % i)
+      comment = content[i:end+2]
+      i = end + 2
+      if not _kept_comment(comment):
+        pending = bool(pending) or '\n' in comment
+        continue
+      token = comment
+    elif c in '\'"`':
+      start = i
+      i = x5_jslex.skip_string(content, i)
+      token = content[start:i]
+    elif c == '/' and _regexp_allowed(''.join(out[-12:])):
+      start = i
+      i = x5_jslex.skip_regexp(content, i)
+      token = content[start:i]
+    elif content.startswith('<!--', i) or content.startswith('-->', i):
+      # Browsers treat these as line comments in scripts.
+      raise MinifierError('HTML comment in script at %s' % i)
+    else:
+      token = c
+      i += 1
+    if pending is not None:
+      prev = out[-1][-1] if out else ''
+      out.append(_js_space(prev, token[0], pending))
+      if out[-1] == '':
+        out.pop()
+      pending = None
+    out.append(token)
+  return ''.join(out)
+
+
+_CSS_PUNCTUATORS = frozenset('{};,>')
+
+
+def minify_css(content):
+  """Removes comments and redundant whitespace from a stylesheet."""
+  out = []
+  pending = False
+  i, n = 0, len(content)
+  while i < n:
+    c = content[i]
+    if c in _WHITESPACE:
+      pending = True
+      i += 1
+      continue
+    if content.startswith('/*', i):
+      end = content.find('*/', i + 2)
+      if end == -1:
+        raise MinifierError('Unterminated comment at %s' % i)
+      token = content[i:end+2]
+      i = end + 2
+      if not _kept_comment(token):
+        pending = True
+        continue
+    elif c in '\'"':
+      start = i
+      i = x5_jslex.skip_string(content, i)
+      token = content[start:i]
+    elif content[i:i+4].lower() == 'url(':
+      end = content.find(')', i)
+      if end == -1:
+        raise MinifierError('Unterminated url at %s' % i)
+      token = content[i:end+1]
+      i = end + 1
+    else:
+      token = c
+      i += 1
+    if token == '}' and out and out[-1] == ';':
+      out.pop()
+    if pending and out:
+      prev = out[-1][-1]
+      if prev == '%' or not (
+          prev in _CSS_PUNCTUATORS or token[0] in _CSS_PUNCTUATORS):
+        out.append(' ')
+    pending = False
+    out.append(token)
+  return ''.join(out)
+
+
+_HTML_RAW_REGEXP = re.compile(
+    r'(<(script|style|pre|textarea)\b[^>]*>)(.*?)(</\2\s*>)', re.I | re.S
+)
+# Keeps conditional comments and the downlevel-revealed '<!--<![endif]-->'.
+_HTML_COMMENT_REGEXP = re.compile(
+    r'<!--(?!\[if\s)(?!<!)(?!\s*\[endif).*?-->', re.S
+)
+_HTML_WHITESPACE_REGEXP = re.compile(r'\s+')
+_JS_TYPES = (
+    'text/javascript', 'application/javascript', 'application/x-javascript'
+)
+
+
+def _html_whitespace(match):
+  return '\n' if '\n' in match.group(0) else ' '
+
+
+def _minify_html_text(text):
+  text = _HTML_COMMENT_REGEXP.sub('', text)
+  return _HTML_WHITESPACE_REGEXP.sub(_html_whitespace, text)
+
+
+def _minify_raw_element(match):
+  """Minifies inline scripts and styles, leaves other raw text alone."""
+  open_tag, tag, body, close_tag = match.groups()
+  tag = tag.lower()
+  if tag == 'script':
+    # Parsed as a tag, so that attributes like data-type are not mistaken
+    # for the script type.
+    _, attrs = x5_utils.parse_start_tag(open_tag)
+    script_type = attrs.get('type', '').strip().lower()
+    if not script_type or script_type in _JS_TYPES:
+      body = minify_js(body)
+  elif tag == 'style':
+    body = minify_css(body)
+  return open_tag + body + close_tag
+
+
+def minify_html(content):
+  """Removes comments and collapses whitespace in a document."""
+  out = []
+  pos = 0
+  for m in _HTML_RAW_REGEXP.finditer(content):
+    out.append(_minify_html_text(content[pos:m.start()]))
+    out.append(_minify_raw_element(m))
+    pos = m.end()
+  out.append(_minify_html_text(content[pos:]))
+  return ''.join(out)
+
+
+MINIFIERS = {
+    'text/css': minify_css,
+    'text/html': minify_html,
+    'application/javascript': minify_js,
+    'application/x-javascript': minify_js,
+}
+
+
+def minify(content, mimetype):
+  """Returns minified content, or None if it cannot or need not be minified.
+
+  Args:
+    content: the converted content.
+    mimetype: the content mimetype, used to select a function in MINIFIERS.
+
+  Returns:
+    The minified content if smaller than the original, or None.
+  """
+  minifier = MINIFIERS.get(mimetype)
+  if minifier is None or not content:
+    return None
+  try:
+    minified = minifier(content)
+  except x5_jslex.JSLexError as e:
+    logger.warning('Not minifying %s content: %s', mimetype, e)
+    return None
+  return minified if len(minified) < len(content) else None
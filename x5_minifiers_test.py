@@ -0,0 +1,55 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+"""Tests for the minifiers."""
+
+import unittest
+
+import x5_minifiers
+
+
+_SCRIPT = 'var a = 1;  // comment\nvar b = 2;'
+
+
+class X5MinifyHtmlScriptTest(unittest.TestCase):
+
+  def _minified(self, open_tag):
+    return x5_minifiers.minify_html(
+        '<html><body>%s%s</script></body></html>' % (open_tag, _SCRIPT)
+    )
+
+  def test_untyped_script(self):
+    self.assertNotIn('// comment', self._minified('<script>'))
+
+  def test_js_type(self):
+    self.assertNotIn(
+        '// comment', self._minified('<script TYPE="text/javascript">')
+    )
+
+  def test_other_type_kept(self):
+    self.assertIn('// comment', self._minified('<script type="text/x-tpl">'))
+
+  def test_data_type_attribute(self):
+    self.assertNotIn(
+        '// comment', self._minified('<script data-type="text/x-tpl">')
+    )
+    self.assertIn(
+        '// comment',
+        self._minified('<script data-type="x" type="text/x-tpl">')
+    )
+
+
+if __name__ == '__main__':
+  unittest.main()
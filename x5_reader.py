@@ -0,0 +1,199 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Block cached, range coalescing file reader for zipped bundles in storage.
+
+zipfile seeks between the central directory and the local headers of each
+member, which with a plain buffered reader turns into one small fetch per
+seek. This reader serves reads from fixed size blocks, and when the members
+about to be read are announced with plan() it fetches each run of adjacent
+blocks in a single call.
+"""
+
+import bisect
+import collections
+import logging
+import zipfile
+
+
+logger = logging.getLogger('x5.reader')
+
+
+_BLOCK_SIZE = 64 * 1024
+# Largest single fetch, the blobstore limit for one call.
+_MAX_FETCH_SIZE = 1015808
+# Memory used by unpinned blocks, least recently used ones are dropped.
+_CACHE_SIZE = 8 * 1024 * 1024
+# Allowance for a local header extra field longer than the central one.
+_LOCAL_HEADER_SLACK = 64
+
+
+class X5RangeReader(object):
+  """Read-only file object over a fetch(start, end) function.
+
+  Attributes:
+    size: the size of the underlying file.
+    fetches: the number of fetch calls made so far.
+  """
+
+  def __init__(self, fetch, size, block_size=_BLOCK_SIZE,
+               max_fetch_size=_MAX_FETCH_SIZE, cache_size=_CACHE_SIZE):
+    self.size = size
+    self.block_size = block_size
+    self.fetches = 0
+    self._fetch = fetch
+    self._max_blocks = max(1, max_fetch_size // block_size)
+    self._cache_blocks = max(self._max_blocks, cache_size // block_size)
+    self._blocks = collections.OrderedDict()
+    self._pinned = {}
+    # Sorted, non overlapping (first, last) block index runs from plan().
+    self._runs = []
+    self._pos = 0
+
+  def seek(self, offset, whence=0):
+    if whence == 1:
+      offset += self._pos
+    elif whence == 2:
+      offset += self.size
+    if offset < 0:
+      raise IOError('Invalid seek offset %s' % offset)
+    self._pos = offset
+
+  def tell(self):
+    return self._pos
+
+  def read(self, n=-1):
+    end = self.size if n is None or n < 0 else min(self.size, self._pos + n)
+    if self._pos >= end:
+      return ''
+    first, last = self._pos // self.block_size, (end - 1) // self.block_size
+    self._load(first, last)
+    data = ''.join(self._block(i) for i in xrange(first, last + 1))
+    offset = self._pos - first * self.block_size
+    data = data[offset:offset + end - self._pos]
+    self._pos = end
+    self._trim()
+    return data
+
+  def close(self):
+    self._blocks.clear()
+    self._pinned.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def pin(self, start, end):
+    """Keeps the blocks for a range, e.g. the central directory, cached."""
+    if start >= end:
+      return
+    first, last = start // self.block_size, (end - 1) // self.block_size
+    self._load(first, last)
+    for i in xrange(first, last + 1):
+      if i in self._blocks:
+        self._pinned[i] = self._blocks.pop(i)
+
+  def plan(self, ranges):
+    """Announces the (start, end) ranges about to be read.
+
+    Ranges are merged into runs of adjacent blocks, so that a read in a run
+    fetches the blocks after it up to the end of the run in the same call.
+    """
+    blocks = set()
+    for start, end in ranges:
+      end = min(end, self.size)
+      if start < end:
+        blocks.update(
+            xrange(start // self.block_size, (end - 1) // self.block_size + 1)
+        )
+    runs = []
+    for i in sorted(blocks):
+      if runs and runs[-1][1] == i - 1:
+        runs[-1][1] = i
+      else:
+        runs.append([i, i])
+    self._runs = [tuple(r) for r in runs]
+
+  def _run_end(self, i):
+    """Returns the last block of the planned run containing block i."""
+    pos = bisect.bisect_right(self._runs, (i, float('inf'))) - 1
+    if pos >= 0 and self._runs[pos][0] <= i <= self._runs[pos][1]:
+      return self._runs[pos][1]
+    return i
+
+  def _cached(self, i):
+    return i in self._pinned or i in self._blocks
+
+  def _block(self, i):
+    if i in self._pinned:
+      return self._pinned[i]
+    data = self._blocks.pop(i)
+    self._blocks[i] = data
+    return data
+
+  def _load(self, first, last):
+    """Fetches the missing blocks in first..last, reading ahead in runs."""
+    i = first
+    while i <= last:
+      if self._cached(i):
+        i += 1
+        continue
+      end = max(last, self._run_end(i))
+      j = i
+      while (j < end and j - i + 1 < self._max_blocks and
+             not self._cached(j + 1)):
+        j += 1
+      self._fetch_blocks(i, j)
+      i = j + 1
+
+  def _fetch_blocks(self, first, last):
+    start = first * self.block_size
+    end = min(self.size, (last + 1) * self.block_size)
+    data = self._fetch(start, end)
+    self.fetches += 1
+    for i in xrange(first, last + 1):
+      offset = (i - first) * self.block_size
+      self._blocks[i] = data[offset:offset + self.block_size]
+
+  def _trim(self):
+    """Drops the least recently used blocks over the cache size."""
+    while len(self._blocks) > self._cache_blocks:
+      self._blocks.popitem(last=False)
+
+
+def plan_members(reader, zipped, names):
+  """Announces the zip members about to be read to an X5RangeReader.
+
+  Args:
+    reader: the file object the zip was opened with, ignored unless it is
+        an X5RangeReader.
+    zipped: the zipfile.ZipFile instance.
+    names: the names or ZipInfo instances of the members.
+  """
+  if not isinstance(reader, X5RangeReader):
+    return
+  ranges = []
+  for name in names:
+    try:
+      info = name if isinstance(name, zipfile.ZipInfo) else zipped.getinfo(
+          name
+      )
+    except KeyError:
+      continue
+    start = info.header_offset
+    ranges.append((start, start + 30 + len(info.filename) + len(info.extra) +
+                   _LOCAL_HEADER_SLACK + info.compress_size))
+  reader.plan(ranges)
@@ -0,0 +1,150 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+"""Tests for the range reader."""
+
+import io
+import unittest
+import zipfile
+
+import x5_reader
+
+
+def _data(size):
+  return ''.join(chr(i % 251) for i in xrange(size))
+
+
+class _Fetcher(object):
+  """Serves ranges of data, recording each call."""
+
+  def __init__(self, data):
+    self.data = data
+    self.calls = []
+
+  def __call__(self, start, end):
+    self.calls.append((start, end))
+    return self.data[start:end]
+
+
+class X5RangeReaderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.data = _data(1000)
+    self.fetch = _Fetcher(self.data)
+    self.reader = x5_reader.X5RangeReader(
+        self.fetch, len(self.data), block_size=100, max_fetch_size=300,
+        cache_size=300
+    )
+
+  def test_read_across_blocks(self):
+    self.reader.seek(150)
+    self.assertEqual(self.reader.read(200), self.data[150:350])
+    self.assertEqual(self.reader.tell(), 350)
+    self.assertEqual(self.fetch.calls, [(100, 400)])
+
+  def test_read_past_end(self):
+    self.reader.seek(-50, 2)
+    self.assertEqual(self.reader.read(100), self.data[950:])
+    self.assertEqual(self.reader.read(), '')
+    self.reader.seek(2000)
+    self.assertEqual(self.reader.read(10), '')
+
+  def test_read_remainder(self):
+    self.reader.seek(420)
+    self.assertEqual(self.reader.read(), self.data[420:])
+    # Split in fetches of at most max_fetch_size.
+    self.assertEqual(self.fetch.calls, [(400, 700), (700, 1000)])
+
+  def test_relative_seek(self):
+    self.reader.seek(90)
+    self.reader.read(20)
+    self.reader.seek(-30, 1)
+    self.assertEqual(self.reader.read(10), self.data[80:90])
+    self.assertRaises(IOError, self.reader.seek, -1)
+
+  def test_cached_blocks(self):
+    self.reader.read(250)
+    self.reader.seek(50)
+    self.reader.read(150)
+    self.assertEqual(self.reader.fetches, 1)
+
+  def test_least_recently_used_blocks_dropped(self):
+    self.reader.read(100)
+    self.reader.seek(500)
+    self.reader.read(300)
+    self.reader.seek(0)
+    self.reader.read(100)
+    self.assertEqual(self.fetch.calls, [(0, 100), (500, 800), (0, 100)])
+
+  def test_pinned_blocks_kept(self):
+    self.reader.pin(900, 1000)
+    self.reader.seek(0)
+    self.reader.read(600)
+    self.reader.seek(950)
+    self.assertEqual(self.reader.read(), self.data[950:])
+    self.assertEqual(self.fetch.calls, [(900, 1000), (0, 300), (300, 600)])
+
+  def test_plan_reads_ahead(self):
+    self.reader.plan([(110, 150), (160, 290), (700, 750)])
+    self.reader.seek(110)
+    self.assertEqual(self.reader.read(10), self.data[110:120])
+    self.reader.seek(260)
+    self.assertEqual(self.reader.read(30), self.data[260:290])
+    self.reader.seek(700)
+    self.reader.read(50)
+    self.assertEqual(self.fetch.calls, [(100, 300), (700, 800)])
+
+
+class X5RangeReaderZipTest(unittest.TestCase):
+
+  def setUp(self):
+    buf = io.BytesIO()
+    self.members = {}
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as z:
+      for i in xrange(20):
+        name = 'images/%02d.png' % i
+        self.members[name] = _data(3000 + i)
+        z.writestr(name, self.members[name])
+    self.data = buf.getvalue()
+    self.fetch = _Fetcher(self.data)
+    self.reader = x5_reader.X5RangeReader(
+        self.fetch, len(self.data), block_size=1024, max_fetch_size=16384
+    )
+
+  def test_members(self):
+    zipped = zipfile.ZipFile(self.reader)
+    for name, content in self.members.items():
+      self.assertEqual(zipped.read(name), content)
+
+  def test_planned_members_fetched_in_runs(self):
+    zipped = zipfile.ZipFile(self.reader)
+    self.reader.pin(zipped.start_dir, self.reader.size)
+    names = sorted(self.members)[:8]
+    x5_reader.plan_members(self.reader, zipped, names)
+    fetches = self.reader.fetches
+    for name in names:
+      self.assertEqual(zipped.read(name), self.members[name])
+    # 8 members of about 3KB each in 16KB fetches.
+    self.assertEqual(self.reader.fetches - fetches, 2)
+
+  def test_plan_ignores_other_readers(self):
+    zipped = zipfile.ZipFile(io.BytesIO(self.data))
+    x5_reader.plan_members(zipped.fp, zipped, list(self.members))
+    x5_reader.plan_members(self.reader, zipped, ['missing.png'])
+    self.assertEqual(self.reader._runs, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,255 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Storage backends for zipped bundles.
+
+Each backend opens a stored bundle as a seekable file object for zipfile,
+using the cheapest access path available: block cached range fetches for
+blobstore, memory maps for local files and plain buffers for tests. Opened
+files and fetchers are closed by the caller, typically in a with statement.
+Backend errors are raised as X5StorageError.
+"""
+
+import errno
+import io
+import logging
+import mmap
+import os
+
+import x5_exceptions
+import x5_reader
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import blobstore as ndb_blobstore
+
+
+logger = logging.getLogger('x5.storage')
+
+
+class _MappedFile(object):
+  """File object over a read-only memory map.
+
+  Python 2 mmap objects have no read() without a size, which zipfile uses.
+  Reads slice the map, so nothing is copied until a member is read.
+  """
+
+  def __init__(self, mapped):
+    self._map = mapped
+
+  def read(self, n=-1):
+    if n is None or n < 0:
+      n = self._map.size() - self._map.tell()
+    return self._map.read(n)
+
+  def seek(self, offset, whence=0):
+    try:
+      self._map.seek(offset, whence)
+    except ValueError as e:
+      raise IOError(e)
+
+  def tell(self):
+    return self._map.tell()
+
+  def close(self):
+    self._map.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+class _Fetcher(object):
+  """A fetch(start, end) function, closing the file it reads from if any."""
+
+  def __init__(self, fetch, fileobj=None):
+    self._fetch = fetch
+    self._fileobj = fileobj
+
+  def __call__(self, start, end):
+    return self._fetch(start, end)
+
+  def close(self):
+    if self._fileobj is not None:
+      self._fileobj.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+class X5Storage(object):
+  """Base class for bundle storage backends."""
+
+  def open(self, key):
+    """Returns a seekable file object for the stored bundle."""
+    raise NotImplementedError()
+
+  def size(self, key):
+    """Returns the size of the stored bundle."""
+    raise NotImplementedError()
+
+  def exists(self, key):
+    try:
+      self.size(key)
+    except x5_exceptions.X5StorageError:
+      return False
+    return True
+
+  @ndb.tasklet
+  def exists_async(self, key):
+    raise ndb.Return(self.exists(key))
+
+  def fetcher(self, key):
+    """Returns a fetch(start, end) function reading from the bundle.
+
+    The bundle is opened once, the function must be closed after use.
+    """
+    fileobj = self.open(key)
+
+    def fetch(start, end):
+      fileobj.seek(start)
+      return fileobj.read(end - start)
+    return _Fetcher(fetch, fileobj)
+
+  def delete(self, keys):
+    """Deletes one or more stored bundles."""
+    raise NotImplementedError()
+
+
+class X5BlobStorage(X5Storage):
+  """App Engine blobstore backend, read through an X5RangeReader."""
+
+  def open(self, key):
+    return x5_reader.X5RangeReader(self.fetcher(key), self.size(key))
+
+  def size(self, key):
+    try:
+      blob_info = blobstore.BlobInfo.get(key)
+    except blobstore.Error as e:
+      raise x5_exceptions.X5StorageError('Cannot read blob %s: %s' % (key, e))
+    if blob_info is None:
+      raise x5_exceptions.X5StorageError('No blob %s' % key)
+    return blob_info.size
+
+  @ndb.tasklet
+  def exists_async(self, key):
+    blob_info = yield ndb_blobstore.BlobInfo.get_async(key)
+    raise ndb.Return(blob_info is not None)
+
+  def fetcher(self, key):
+    def fetch(start, end):
+      chunks = []
+      try:
+        while start < end:
+          chunk_end = min(end, start + blobstore.MAX_BLOB_FETCH_SIZE)
+          # The blobstore end index is inclusive.
+          chunks.append(blobstore.fetch_data(key, start, chunk_end - 1))
+          start = chunk_end
+      except blobstore.Error as e:
+        raise x5_exceptions.X5StorageError(
+            'Cannot read blob %s: %s' % (key, e)
+        )
+      return ''.join(chunks)
+    return _Fetcher(fetch)
+
+  def delete(self, keys):
+    try:
+      blobstore.delete(keys)
+    except blobstore.Error as e:
+      raise x5_exceptions.X5StorageError('Cannot delete blobs: %s' % e)
+
+
+class X5LocalStorage(X5Storage):
+  """Local filesystem backend, keys are paths relative to a root folder.
+
+  Bundles are memory mapped, so zip members are read straight from the page
+  cache without copying the file into the process.
+  """
+
+  def __init__(self, root):
+    self.root = root
+
+  def _path(self, key):
+    path = os.path.normpath(os.path.join(self.root, str(key)))
+    if not path.startswith(os.path.normpath(self.root) + os.sep):
+      raise x5_exceptions.X5StorageError('Invalid key %s' % key)
+    return path
+
+  def open(self, key):
+    try:
+      with open(self._path(key), 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+          # Empty files cannot be mapped.
+          return io.BytesIO()
+        return _MappedFile(
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        )
+    except (IOError, OSError, mmap.error) as e:
+      raise x5_exceptions.X5StorageError('Cannot open %s: %s' % (key, e))
+
+  def size(self, key):
+    try:
+      return os.path.getsize(self._path(key))
+    except OSError as e:
+      raise x5_exceptions.X5StorageError('Cannot read %s: %s' % (key, e))
+
+  def delete(self, keys):
+    if not isinstance(keys, (list, tuple)):
+      keys = [keys]
+    for key in keys:
+      try:
+        os.remove(self._path(key))
+      except OSError as e:
+        if e.errno == errno.ENOENT:
+          # Already deleted, e.g. by an interrupted cleanup run.
+          continue
+        raise x5_exceptions.X5StorageError('Cannot delete %s: %s' % (key, e))
+
+
+class X5MemoryStorage(X5Storage):
+  """In-memory backend for tests and benchmarks."""
+
+  def __init__(self, bundles=None):
+    self.bundles = dict(bundles or {})
+
+  def _data(self, key):
+    try:
+      return self.bundles[key]
+    except KeyError:
+      raise x5_exceptions.X5StorageError('No bundle %s' % key)
+
+  def open(self, key):
+    return io.BytesIO(self._data(key))
+
+  def size(self, key):
+    return len(self._data(key))
+
+  def fetcher(self, key):
+    data = self._data(key)
+    return _Fetcher(lambda start, end: data[start:end])
+
+  def delete(self, keys):
+    if not isinstance(keys, (list, tuple)):
+      keys = [keys]
+    for key in keys:
+      self.bundles.pop(key, None)
+
+
+# Backend for the bundles uploaded to the app.
+blob_storage = X5BlobStorage()
@@ -0,0 +1,174 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+"""Tests for the bundle storage backends."""
+
+import collections
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import x5_exceptions
+import x5_reader
+import x5_storage
+
+
+def _zip_data():
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, 'w') as z:
+    z.writestr('index.html', '<html></html>')
+    z.writestr('images/a.png', '\x89PNG' * 1000)
+  return buf.getvalue()
+
+
+_BlobInfo = collections.namedtuple('_BlobInfo', 'size')
+
+
+class _FakeBlobstore(object):
+  """The blobstore functions used by X5BlobStorage, over a dict."""
+
+  Error = x5_storage.blobstore.Error
+  MAX_BLOB_FETCH_SIZE = 1000
+
+  def __init__(self, blobs):
+    self.blobs = blobs
+    self.fetches = []
+    # Stands for the BlobInfo class, of which only get is used.
+    self.BlobInfo = self  # pylint: disable=invalid-name
+
+  def get(self, key):
+    if key not in self.blobs:
+      return None
+    return _BlobInfo(len(self.blobs[key]))
+
+  def fetch_data(self, key, start, end):
+    self.fetches.append((start, end))
+    return self.blobs[key][start:end + 1]
+
+  def delete(self, keys):
+    for key in keys:
+      self.blobs.pop(key, None)
+
+
+class _StorageTests(object):
+  """Tests shared by the backends, which store the bundle as 'bundle'."""
+
+  def test_open(self):
+    with self.storage.open('bundle') as fileobj:
+      zipped = zipfile.ZipFile(fileobj)
+      self.assertEqual(zipped.read('index.html'), '<html></html>')
+      self.assertEqual(zipped.read('images/a.png'), '\x89PNG' * 1000)
+
+  def test_size(self):
+    self.assertEqual(self.storage.size('bundle'), len(self.data))
+    self.assertRaises(x5_exceptions.X5StorageError, self.storage.size,
+                      'missing')
+
+  def test_fetcher(self):
+    with self.storage.fetcher('bundle') as fetch:
+      self.assertEqual(fetch(0, 4), self.data[:4])
+      self.assertEqual(fetch(10, 2500), self.data[10:2500])
+      self.assertEqual(fetch(len(self.data) - 5, len(self.data)),
+                       self.data[-5:])
+
+  def test_exists(self):
+    self.assertTrue(self.storage.exists('bundle'))
+    self.assertFalse(self.storage.exists('missing'))
+
+  def test_delete(self):
+    self.storage.delete(['bundle'])
+    self.assertFalse(self.storage.exists('bundle'))
+
+
+class X5MemoryStorageTest(_StorageTests, unittest.TestCase):
+
+  def setUp(self):
+    self.data = _zip_data()
+    self.storage = x5_storage.X5MemoryStorage({'bundle': self.data})
+
+  def test_delete_single_key(self):
+    self.storage.delete('bundle')
+    self.assertEqual(self.storage.bundles, {})
+
+
+class X5LocalStorageTest(_StorageTests, unittest.TestCase):
+
+  def setUp(self):
+    self.data = _zip_data()
+    self.root = tempfile.mkdtemp()
+    with open(os.path.join(self.root, 'bundle'), 'wb') as f:
+      f.write(self.data)
+    self.storage = x5_storage.X5LocalStorage(self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_open_empty(self):
+    open(os.path.join(self.root, 'empty'), 'wb').close()
+    with self.storage.open('empty') as fileobj:
+      self.assertEqual(fileobj.read(), '')
+
+  def test_open_missing(self):
+    self.assertRaises(x5_exceptions.X5StorageError, self.storage.open,
+                      'missing')
+
+  def test_path_outside_root(self):
+    for key in ('../bundle', '/etc/passwd', 'a/../../bundle'):
+      self.assertRaises(x5_exceptions.X5StorageError, self.storage.open, key)
+      self.assertRaises(x5_exceptions.X5StorageError, self.storage.size, key)
+
+  def test_mapped_file(self):
+    with self.storage.open('bundle') as fileobj:
+      fileobj.seek(-4, 2)
+      self.assertEqual(fileobj.read(), self.data[-4:])
+      self.assertEqual(fileobj.tell(), len(self.data))
+      self.assertRaises(IOError, fileobj.seek, -1)
+
+  def test_delete_missing(self):
+    self.storage.delete('bundle')
+    self.storage.delete('bundle')
+    self.assertFalse(self.storage.exists('bundle'))
+
+
+class X5BlobStorageTest(_StorageTests, unittest.TestCase):
+
+  def setUp(self):
+    self.data = _zip_data()
+    self.blobstore = _FakeBlobstore({'bundle': self.data})
+    self._blobstore = x5_storage.blobstore
+    x5_storage.blobstore = self.blobstore
+    self.storage = x5_storage.X5BlobStorage()
+
+  def tearDown(self):
+    x5_storage.blobstore = self._blobstore
+
+  def test_open_range_reader(self):
+    with self.storage.open('bundle') as fileobj:
+      self.assertIsInstance(fileobj, x5_reader.X5RangeReader)
+
+  def test_fetches_split(self):
+    with self.storage.fetcher('bundle') as fetch:
+      fetch(0, 2500)
+    # The blobstore end index is inclusive.
+    self.assertEqual(
+        self.blobstore.fetches, [(0, 999), (1000, 1999), (2000, 2499)]
+    )
+
+
+if __name__ == '__main__':
+  unittest.main()
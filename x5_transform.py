@@ -15,18 +15,23 @@
 """X5 transform request."""
 
 import base64
+import collections
 import datetime
 import hashlib
 import logging
+import os
+import threading
 import time
 import urlparse
 
+import env
 import x5_bundle
 import x5_exceptions
+import x5_storage
 
 from lxml import etree
 
-from google.appengine.ext import blobstore
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 
@@ -39,6 +44,65 @@ def tag_strip(s):
   ).decode('utf-8')
 
 
+# Number of transforms processed by each submitted creatives backfill task.
+_BACKFILL_BATCH_SIZE = 200
+
+# Fields shown in the user transforms listing, all indexed.
+LISTING_PROJECTION = (
+    'filename', 'created', 'creative_id', 'network_code', 'modified'
+)
+
+# Status of transforms uploaded in a batch, set by prepare_transform.
+STATUS_PENDING = 'pending'
+STATUS_READY = 'ready'
+STATUS_ERROR = 'error'
+
+# Memory used by the transformed bundles kept by each instance, a fraction
+# of the smallest instance class memory.
+_BUNDLE_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class X5BundleCache(object):
+  """Thread safe LRU cache of transformed bundles by content hash.
+
+  Bundles are not modified once transformed, so the same instance can serve
+  all transforms of byte-identical uploads. The cache is bounded by the
+  memory size of the bundles, bundles larger than the bound are not kept.
+  """
+
+  def __init__(self, max_bytes=_BUNDLE_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._lock = threading.Lock()
+    # (bundle, memory size) tuples by content hash.
+    self._bundles = collections.OrderedDict()
+
+  def get(self, content_hash):
+    with self._lock:
+      entry = self._bundles.pop(content_hash, None)
+      if entry is None:
+        return None
+      self._bundles[content_hash] = entry
+      return entry[0]
+
+  def put(self, content_hash, bundle):
+    size = bundle.memory_size
+    with self._lock:
+      entry = self._bundles.pop(content_hash, None)
+      if entry is not None:
+        self.size -= entry[1]
+      if size > self.max_bytes:
+        return
+      self._bundles[content_hash] = (bundle, size)
+      self.size += size
+      while self.size > self.max_bytes:
+        _, (_, evicted) = self._bundles.popitem(last=False)
+        self.size -= evicted
+
+
+_bundle_cache = X5BundleCache()
+
+
 class X5Transform(ndb.Model):
   """Ndb instance for X5 transform request."""
 
@@ -56,6 +120,22 @@ class X5Transform(ndb.Model):
   )
   modified = ndb.DateTimeProperty(required=False, auto_now=True)
 
+  # Backend holding the bundles referenced by blob_key.
+  storage = x5_storage.blob_storage
+
+  # MD5 hex digest of the uploaded zip, shared by byte-identical uploads.
+  content_hash = ndb.StringProperty(required=False, indexed=True)
+  advertiser_id = ndb.IntegerProperty(required=False, indexed=False)
+  # Content MD5 of the submitted creative assets, by macro name.
+  asset_hashes = ndb.JsonProperty(required=False, indexed=False)
+  # Set for bundles uploaded together, with the status of their transform.
+  batch_id = ndb.StringProperty(required=False, indexed=True)
+  status = ndb.StringProperty(required=False, indexed=False)
+  # From the zip manifest read at upload, shown before the transform.
+  entry_count = ndb.IntegerProperty(required=False, indexed=False)
+  content_size = ndb.IntegerProperty(required=False, indexed=False)
+  snippet_names = ndb.StringProperty(repeated=True, indexed=False)
+
   def _pre_put_hook(self):
     if self.network_code is None:
       raise x5_exceptions.X5TransformError(
@@ -69,10 +149,13 @@ class X5Transform(ndb.Model):
   def _generate_x5_id(self):
     if not self.key or not self.key.parent():
       raise x5_exceptions.X5TransformError('Cannot generate id, no parent')
-    return base64.b64encode(hashlib.md5('%s%s%s' % (
+    # Bundles uploaded together are created within the same second.
+    return base64.b64encode(hashlib.md5('%s%s%s%s%s' % (
         self.network_code,
         self.key.parent().id(),
-        time.mktime(self.created.timetuple())
+        time.mktime(self.created.timetuple()),
+        self.created.microsecond,
+        (self.filename or u'').encode('utf-8')
     )).digest(), '_-')[:-2]
 
   @classmethod
@@ -83,12 +166,109 @@ class X5Transform(ndb.Model):
   def user_transforms(cls, user_id):
     return cls.query(ancestor=cls.parent_key(user_id)).order(-cls.created)
 
-  @property
-  def _reader(self):
-    if not hasattr(self, '_blobreader'):
-      self._blobreader = blobstore.BlobReader(self.blob_key)
-    self._blobreader.seek(0)
-    return self._blobreader
+  @classmethod
+  def user_transforms_page(cls, user_id, page_size, cursor=None):
+    return cls.user_transforms_page_async(
+        user_id, page_size, cursor
+    ).get_result()
+
+  @classmethod
+  def user_transforms_page_async(cls, user_id, page_size, cursor=None):
+    """Returns a future for a page of the user's transforms for the listing.
+
+    Only the listed fields are fetched via a projection query, so the cost of
+    a page does not depend on the size of the user's history.
+
+    Args:
+      user_id: the id of the user owning the transforms.
+      page_size: the maximum number of transforms to return.
+      cursor: an optional urlsafe cursor string from a previous page.
+
+    Returns:
+      A future for a (transforms, cursor, more) tuple, as returned by ndb
+      fetch_page.
+    """
+    if cursor and not isinstance(cursor, ndb.Cursor):
+      cursor = ndb.Cursor(urlsafe=cursor)
+    return cls.user_transforms(user_id).fetch_page_async(
+        page_size, start_cursor=cursor or None, projection=LISTING_PROJECTION
+    )
+
+  @classmethod
+  def filtered(cls, network_code=None, created_from=None, created_to=None):
+    """Returns the query for the transforms matching filters, newest first.
+
+    Submitted transforms cannot be selected in the same query, as creative_id
+    would be a second inequality filter; callers skip the others.
+    """
+    query = cls.query()
+    if network_code:
+      query = query.filter(cls.network_code == network_code)
+    if created_from:
+      query = query.filter(cls.created >= created_from)
+    if created_to:
+      query = query.filter(cls.created < created_to)
+    return query.order(-cls.created)
+
+  @classmethod
+  def user_batch(cls, user_id, batch_id):
+    """Returns the user's transforms uploaded in a batch, by filename."""
+    transforms = cls.query(
+        cls.batch_id == batch_id, ancestor=cls.parent_key(user_id)
+    ).fetch()
+    return sorted(transforms, key=lambda t: t.filename)
+
+  @classmethod
+  @ndb.tasklet
+  def find_by_content_async(cls, content_hash):
+    """Returns a recent transform for the same content, or None.
+
+    Only transforms created in the first half of the retention period are
+    considered, so that the cleanup job cannot be deleting the shared blob
+    while a new transform starts referencing it.
+
+    Args:
+      content_hash: the MD5 hex digest of the uploaded zip.
+
+    Returns:
+      The most recent transform with the same content and an existing blob.
+    """
+    if not content_hash:
+      raise ndb.Return(None)
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        hours=env.TRANSFORM_RETENTION_HOURS / 2.0
+    )
+    query = cls.query(
+        cls.content_hash == content_hash, cls.created >= cutoff
+    ).order(-cls.created)
+    x5transforms = yield query.fetch_async(5)
+    exists = yield [
+        cls.storage.exists_async(x5transform.blob_key)
+        for x5transform in x5transforms
+    ]
+    for x5transform, blob_exists in zip(x5transforms, exists):
+      if blob_exists:
+        raise ndb.Return(x5transform)
+    raise ndb.Return(None)
+
+  @classmethod
+  @ndb.tasklet
+  def submitted_for_content_async(cls, content_hash, network_code):
+    """Returns transforms of the same content already submitted to network."""
+    if not content_hash:
+      raise ndb.Return([])
+    x5transforms = yield cls.query(
+        cls.content_hash == content_hash, cls.network_code == network_code,
+        cls.creative_id > 0
+    ).fetch_async(20)
+    raise ndb.Return(x5transforms)
+
+  def _open_blob(self):
+    """Opens the zipped bundle, the file object must be closed after use."""
+    try:
+      return self.storage.open(self.blob_key)
+    except x5_exceptions.X5StorageError as e:
+      raise x5_exceptions.X5TransformError(e.args[0])
 
   @property
   def snippets(self):
@@ -101,20 +281,49 @@ class X5Transform(ndb.Model):
   @property
   def bundle(self):
     if not hasattr(self, '_x5bundle'):
-      try:
-        x5bundle = x5_bundle.X5Bundle.zip_factory(self.x5_id, self._reader)
-        x5bundle.transform()
-      except blobstore.Error as e:
-        raise x5_exceptions.X5TransformError('Cannot open blobstore blob: %s' %
-                                             e.args[0])
-      except x5_exceptions.X5BundleError as e:
-        raise x5_exceptions.X5TransformError('Cannot transform the blob: %s' %
-                                             e.args[0])
+      cached = _bundle_cache.get(self.content_hash)
+      if cached is not None:
+        self._x5bundle = cached
+        return cached
+      x5bundle = self._transform_bundle(env.OPTIMIZE_IMAGES)
       self._x5bundle = x5bundle
+      if self.content_hash:
+        _bundle_cache.put(self.content_hash, x5bundle)
     return self._x5bundle
 
+  def _transform_bundle(self, optimize_images):
+    """Reads and transforms the bundle, optionally optimizing its images."""
+    try:
+      with self._open_blob() as reader:
+        x5bundle = x5_bundle.X5Bundle.zip_factory(self.x5_id, reader)
+        x5bundle.transform()
+        if optimize_images:
+          reader.seek(0)
+          x5bundle.optimize_assets(self.x5_id, reader)
+    except x5_exceptions.X5StorageError as e:
+      raise x5_exceptions.X5TransformError('Cannot open the blob: %s' %
+                                           e.args[0])
+    except x5_exceptions.X5BundleError as e:
+      raise x5_exceptions.X5TransformError('Cannot transform the blob: %s' %
+                                           e.args[0])
+    return x5bundle
+
+  def check(self):
+    """Checks that the bundle can be transformed, without keeping it.
+
+    Images are not optimized, the costliest step and one that does not
+    decide whether a bundle can be transformed.
+
+    Raises:
+      X5TransformError: if the bundle cannot be read or transformed.
+    """
+    if (hasattr(self, '_x5bundle') or
+        _bundle_cache.get(self.content_hash) is not None):
+      return
+    self._transform_bundle(False)
+
   def get_creative(self, snippet_name, advertiser_id, url, size,
-                   creative_name=None, interstitial=0):
+                   creative_name=None, interstitial=0, reuse_assets=False):
     """Returns the creative in the format expected by the API.
 
     Args:
@@ -125,6 +334,8 @@ class X5Transform(ndb.Model):
       size: creative size, in the 'widthxheight' format.
       creative_name: name to assign to creative, auto-generated if not set.
       interstitial: flag this as interstitial (currently unused).
+      reuse_assets: reference assets already uploaded to the network by id
+          instead of uploading their content again.
 
     Returns:
       A dictionary with the creative fields to be passed to the API.
@@ -146,13 +357,26 @@ class X5Transform(ndb.Model):
     except (TypeError, ValueError):
       raise x5_exceptions.X5TransformError("Invalid URL '%s'" % url)
 
+    # Content hashes by macro name, to record the uploaded assets ids.
+    self.asset_hashes = {}
+    bundle = self.bundle
     try:
-      creative = self.bundle.get_creative_part(
-          self.x5_id, self._reader, snippet_name
-      )
+      with self._open_blob() as reader:
+        creative = bundle.get_creative_part(
+            self.x5_id, reader, snippet_name,
+            max_size=(width, height) if env.OPTIMIZE_IMAGES else None,
+            hashes=self.asset_hashes
+        )
     except x5_exceptions.X5BundleError as e:
       raise x5_exceptions.X5TransformError(e.args[0])
 
+    self.reused_assets = 0
+    if reuse_assets:
+      self.reused_assets = X5NetworkAsset.reuse(
+          self.network_code, creative['customCreativeAssets'],
+          self.asset_hashes
+      )
+
     if creative_name:
       creative_name = tag_strip(creative_name)
     else:
@@ -167,3 +391,248 @@ class X5Transform(ndb.Model):
     })
 
     return creative
+
+
+  def as_update(self, creative, existing, previous=None):
+    """Turns a creative into an update of an existing one.
+
+    Assets whose content did not change since the transform that last
+    submitted the existing creative keep their DFP asset ids, so only the
+    changed assets are uploaded.
+
+    Args:
+      creative: the creative dict returned by get_creative.
+      existing: the existing CustomCreative, as returned by the API.
+      previous: the transform that last submitted the existing creative, as
+          returned by latest_for_creative_async, or None.
+
+    Returns:
+      The number of assets that will be uploaded.
+    """
+    creative['id'] = existing['id']
+    asset_ids = {}
+    if previous is not None and previous.asset_hashes:
+      existing_ids = dict(
+          (a['macroName'], a['asset']['assetId'])
+          for a in getattr(existing, 'customCreativeAssets', None) or []
+      )
+      for macro, content_hash in previous.asset_hashes.items():
+        if macro in existing_ids:
+          asset_ids[content_hash] = existing_ids[macro]
+    uploaded = 0
+    for creative_asset in creative['customCreativeAssets']:
+      content_hash = self.asset_hashes.get(creative_asset['macroName'])
+      asset_id = asset_ids.get(content_hash)
+      if asset_id is not None:
+        creative_asset['asset'] = {
+            'assetId': asset_id,
+            'fileName': creative_asset['asset']['fileName']
+        }
+      elif 'assetByteArray' in creative_asset['asset']:
+        uploaded += 1
+    logger.info(
+        'Updating creative %s, %s of %s assets changed', existing['id'],
+        uploaded, len(creative['customCreativeAssets'])
+    )
+    return uploaded
+
+  @classmethod
+  @ndb.tasklet
+  def latest_for_creative_async(cls, network_code, creative_id):
+    """Returns the latest transform submitted as creative_id, or None."""
+    transforms = yield cls.query(
+        cls.creative_id == creative_id, cls.network_code == network_code
+    ).order(-cls.created).fetch_async(1)
+    raise ndb.Return(transforms[0] if transforms else None)
+
+
+class X5SubmittedCreative(ndb.Model):
+  """Ndb instance for the latest submitted creative of a bundle filename.
+
+  Keyed by network code and bundle basename, and updated when a creative is
+  submitted, so that the admin listing is a plain paginated query instead of
+  a scan of all transforms deduplicated in memory.
+  """
+
+  transform_key = ndb.KeyProperty(
+      kind=X5Transform, required=True, indexed=False
+  )
+  filename = ndb.StringProperty(required=True, indexed=False)
+  blob_key = ndb.BlobKeyProperty(required=True, indexed=False)
+  network_code = ndb.StringProperty(required=True, indexed=True)
+  creative_id = ndb.IntegerProperty(required=True, indexed=True)
+  # Creation time of the transform, used for ordering and date filters.
+  created = ndb.DateTimeProperty(required=True, indexed=True)
+
+  @classmethod
+  def name_for(cls, x5transform):
+    return os.path.basename(x5transform.filename or '') or x5transform.x5_id
+
+  @classmethod
+  def key_for(cls, x5transform):
+    return ndb.Key(cls, '%s:%s' % (
+        x5transform.network_code, cls.name_for(x5transform)
+    ))
+
+  @classmethod
+  def record(cls, x5transform):
+    return cls.record_async(x5transform).get_result()
+
+  @classmethod
+  @ndb.transactional_tasklet
+  def record_async(cls, x5transform):
+    """Records a submitted transform unless a newer one has the same name."""
+    key = cls.key_for(x5transform)
+    latest = yield key.get_async()
+    if latest is not None and latest.created > x5transform.created:
+      raise ndb.Return(latest)
+    latest = cls(
+        key=key, transform_key=x5transform.key,
+        filename=cls.name_for(x5transform),
+        blob_key=x5transform.blob_key, network_code=x5transform.network_code,
+        creative_id=x5transform.creative_id, created=x5transform.created
+    )
+    yield latest.put_async()
+    raise ndb.Return(latest)
+
+  @classmethod
+  def listing(cls, page_size, cursor=None, network_code=None,
+              created_from=None, created_to=None):
+    """Returns a page of submitted creatives, newest first.
+
+    Args:
+      page_size: the maximum number of creatives to return.
+      cursor: an optional urlsafe cursor string from a previous page.
+      network_code: only return creatives for this network.
+      created_from: only return creatives created on or after this datetime.
+      created_to: only return creatives created before this datetime.
+
+    Returns:
+      A (creatives, cursor, more) tuple, as returned by ndb fetch_page.
+    """
+    query = cls.filtered(network_code, created_from, created_to)
+    if cursor and not isinstance(cursor, ndb.Cursor):
+      cursor = ndb.Cursor(urlsafe=cursor)
+    return query.fetch_page(page_size, start_cursor=cursor or None)
+
+  @classmethod
+  def filtered(cls, network_code=None, created_from=None, created_to=None):
+    """Returns the query for submitted creatives matching the filters."""
+    query = cls.query()
+    if network_code:
+      query = query.filter(cls.network_code == network_code)
+    if created_from:
+      query = query.filter(cls.created >= created_from)
+    if created_to:
+      query = query.filter(cls.created < created_to)
+    return query.order(-cls.created)
+
+
+class X5NetworkAsset(ndb.Model):
+  """Ndb instance for an asset already uploaded to a DFP network.
+
+  Keyed by network code and content MD5, so that creatives using the same
+  content reference the existing DFP asset id instead of uploading it again.
+  """
+
+  asset_id = ndb.IntegerProperty(required=True, indexed=False)
+  created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+  @classmethod
+  def key_for(cls, network_code, content_hash):
+    return ndb.Key(cls, '%s:%s' % (network_code, content_hash))
+
+  @classmethod
+  def reuse(cls, network_code, creative_assets, hashes):
+    """Replaces the content of already uploaded assets with their ids.
+
+    Args:
+      network_code: the DFP network the creative is uploaded to.
+      creative_assets: the CustomCreativeAsset dicts of the creative.
+      hashes: the content MD5 of each asset, by macro name.
+
+    Returns:
+      The number of assets referenced by id.
+    """
+    creative_assets = [
+        a for a in creative_assets if hashes.get(a['macroName'])
+    ]
+    entries = ndb.get_multi([
+        cls.key_for(network_code, hashes[a['macroName']])
+        for a in creative_assets
+    ])
+    reused = 0
+    for creative_asset, entry in zip(creative_assets, entries):
+      if entry is None:
+        continue
+      creative_asset['asset'] = {
+          'assetId': entry.asset_id,
+          'fileName': creative_asset['asset']['fileName']
+      }
+      reused += 1
+    if reused:
+      logger.info('Reusing %s assets in network %s', reused, network_code)
+    return reused
+
+  @classmethod
+  @ndb.tasklet
+  def record_async(cls, network_code, creative, hashes):
+    """Records the asset ids of a creative returned by the API.
+
+    Args:
+      network_code: the DFP network the creative was uploaded to.
+      creative: the creative returned by createCreatives.
+      hashes: the content MD5 of each asset, by macro name.
+    """
+    entries = {}
+    for creative_asset in getattr(creative, 'customCreativeAssets', None) or []:
+      content_hash = hashes.get(creative_asset['macroName'])
+      asset_id = getattr(creative_asset['asset'], 'assetId', None)
+      if content_hash and asset_id:
+        entries[content_hash] = cls(
+            key=cls.key_for(network_code, content_hash), asset_id=asset_id
+        )
+    yield ndb.put_multi_async(entries.values())
+
+
+def prepare_transform(transform_key):
+  """Deferred task checking a bundle uploaded in a batch.
+
+  This is only a validation pass: the transformed bundle is not stored, the
+  review page transforms it again. Bundles that cannot be transformed are
+  flagged for the batch review page. Errors are not raised, the task would
+  otherwise be retried on a bundle that cannot be read.
+  """
+  x5transform = transform_key.get()
+  if x5transform is None:
+    return
+  try:
+    x5transform.check()
+  except x5_exceptions.X5TransformError as e:
+    logger.warning('Cannot transform %s: %s', x5transform.filename, e)
+    x5transform.status = STATUS_ERROR
+  except Exception:  # pylint: disable=broad-except
+    logger.exception('Error transforming %s', x5transform.filename)
+    x5transform.status = STATUS_ERROR
+  else:
+    x5transform.status = STATUS_READY
+  x5transform.put()
+
+
+def backfill_submitted_creatives(cursor=None):
+  """Deferred task recording all submitted transforms, one batch per run."""
+  query = X5Transform.query(X5Transform.creative_id > 0)
+  transforms, cursor, more = query.fetch_page(
+      _BACKFILL_BATCH_SIZE,
+      start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None
+  )
+  for x5transform in transforms:
+    X5SubmittedCreative.record(x5transform)
+  # Entries written before the network code was part of the key.
+  ndb.delete_multi(set(
+      ndb.Key(X5SubmittedCreative, X5SubmittedCreative.name_for(t))
+      for t in transforms
+  ))
+  logger.info('Backfilled %s submitted creatives', len(transforms))
+  if more and cursor:
+    deferred.defer(backfill_submitted_creatives, cursor.urlsafe())
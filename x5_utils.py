@@ -18,6 +18,26 @@ import re
 import urllib
 
 
+_START_TAG_REGEXP = re.compile(
+    r'<([a-zA-Z][^\s/>]*)((?:"[^"]*"|\'[^\']*\'|[^\'">])*)>'
+)
+_TAG_ATTR_REGEXP = re.compile(
+    r'([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+)))?'
+)
+
+
+def parse_start_tag(tag):
+  """Returns the lowercased name and an attributes dict for an HTML tag."""
+  m = _START_TAG_REGEXP.match(tag)
+  if not m:
+    return None, {}
+  attrs = {}
+  for a in _TAG_ATTR_REGEXP.finditer(m.group(2)):
+    value = [v for v in a.groups()[1:] if v is not None]
+    attrs[a.group(1).lower()] = value[0] if value else ''
+  return m.group(1).lower(), attrs
+
+
 def quoted_unquoted_tokens(tokens):
   """Return a set of tokens in verbatim and quoted form."""
   return set(itertools.chain(tokens, (urllib.quote(k) for k in tokens)))
@@ -44,7 +64,11 @@ def all_groups_match(regexp, text):
 
 
 def _match_function(snippet, assets, match, template=None):
-  """Base match function that replaces asset names with macros in snippet."""
+  """Base match function that replaces asset names with macros in snippet.
+
+  Assets small enough to have a data URI are replaced with it instead, and
+  recorded in the snippet data URIs rather than in its assets.
+  """
   name = match.group(1)
   if '%' in name:
     name = urllib.unquote(name)
@@ -52,6 +76,10 @@ def _match_function(snippet, assets, match, template=None):
     asset = assets[name]
   except KeyError:
     return match.group(1)
+  data_uri = getattr(asset, 'data_uri', None)
+  if data_uri and template is None:
+    snippet.data_uris.append(asset.name)
+    return data_uri
   snippet.assets.append(asset.name)
   return (template or '%%%%FILE:%(id)s%%%%') % {'id': asset.id}
 
@@ -0,0 +1,194 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Upload time validation of zipped bundles from their central directory.
+
+Only the end of central directory record and the central directory are
+read, which for a bundle is a few kilobytes at the end of the file, so that
+non-zip files, bundles without snippets and zip bombs are rejected without
+decompressing anything.
+"""
+
+import collections
+import logging
+import struct
+
+import x5_bundle
+import x5_exceptions
+
+
+logger = logging.getLogger('x5.zipcheck')
+
+
+# Entry names are byte strings, as the member names keyed in X5Bundle.
+X5ZipEntry = collections.namedtuple(
+    'X5ZipEntry', 'name size compressed_size'
+)
+X5ZipManifest = collections.namedtuple(
+    'X5ZipManifest', 'entries snippets size'
+)
+
+
+# Limits on the uncompressed content, well above any legitimate bundle. The
+# content is at most the size of the largest upload, as the transformed
+# bundle is held in memory and its assets are each uploaded under
+# env.ASSET_SIZE_LIMIT anyway.
+_MAX_ENTRIES = 5000
+_MAX_TOTAL_SIZE = 50 * 1024 * 1024
+_MAX_CENTRAL_DIR_SIZE = 4 * 1024 * 1024
+# Compression ratio above which an entry larger than _RATIO_MIN_SIZE is
+# considered a zip bomb; text compresses well but not this well.
+_MAX_RATIO = 100
+_RATIO_MIN_SIZE = 1024 * 1024
+
+_EOCD = struct.Struct('<4s4H2LH')
+_EOCD_SIGNATURE = 'PK\x05\x06'
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_LOCATOR_SIGNATURE = 'PK\x06\x07'
+_ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+_ZIP64_EOCD_SIGNATURE = 'PK\x06\x06'
+_CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+_CENTRAL_DIR_SIGNATURE = 'PK\x01\x02'
+_ZIP64_EXTRA_ID = 1
+_ZIP64_LIMIT = 0xffffffff
+_FLAG_ENCRYPTED = 0x1
+# The end of central directory record, its comment and the zip64 records.
+_TAIL_SIZE = _EOCD.size + 0xffff + _ZIP64_LOCATOR.size + _ZIP64_EOCD.size
+
+
+def _end_of_central_dir(tail, tail_offset):
+  """Returns (entries, cd_size, cd_offset, cd_end) from the archive tail."""
+  pos = tail.rfind(_EOCD_SIGNATURE)
+  while pos >= 0:
+    # The comment must run exactly to the end of the file.
+    record = tail[pos:pos + _EOCD.size]
+    if len(record) == _EOCD.size:
+      fields = _EOCD.unpack(record)
+      if pos + _EOCD.size + fields[7] == len(tail):
+        break
+    pos = tail.rfind(_EOCD_SIGNATURE, 0, pos)
+  else:
+    raise x5_exceptions.X5ZipError('Not a zip archive')
+  _, disk, cd_disk, _, entries, cd_size, cd_offset, _ = fields
+  if disk or cd_disk:
+    raise x5_exceptions.X5ZipError('Multi-disk zip archives not supported')
+  cd_end = tail_offset + pos
+  locator_pos = pos - _ZIP64_LOCATOR.size
+  if (locator_pos >= 0 and
+      tail[locator_pos:locator_pos + 4] == _ZIP64_LOCATOR_SIGNATURE):
+    _, _, eocd64_offset, _ = _ZIP64_LOCATOR.unpack(
+        tail[locator_pos:pos]
+    )
+    eocd64_pos = locator_pos - _ZIP64_EOCD.size
+    record = tail[eocd64_pos:locator_pos] if eocd64_pos >= 0 else ''
+    if (len(record) != _ZIP64_EOCD.size or
+        not record.startswith(_ZIP64_EOCD_SIGNATURE)):
+      raise x5_exceptions.X5ZipError('Invalid zip64 end of central directory')
+    fields = _ZIP64_EOCD.unpack(record)
+    entries, cd_size, cd_offset = fields[7], fields[8], fields[9]
+    cd_end = tail_offset + eocd64_pos
+  return entries, cd_size, cd_offset, cd_end
+
+
+def _zip64_sizes(extra, size, compressed_size):
+  """Returns the sizes from the zip64 extra field if they overflowed."""
+  i = 0
+  while i + 4 <= len(extra):
+    tag, length = struct.unpack('<2H', extra[i:i + 4])
+    if tag == _ZIP64_EXTRA_ID:
+      values = list(struct.unpack(
+          '<%sQ' % (min(length, 16) // 8), extra[i + 4:i + 4 + min(length, 16)]
+      ))
+      if size == _ZIP64_LIMIT and values:
+        size = values.pop(0)
+      if compressed_size == _ZIP64_LIMIT and values:
+        compressed_size = values.pop(0)
+      break
+    i += 4 + length
+  return size, compressed_size
+
+
+def _entries(central_dir, count):
+  """Yields an X5ZipEntry for each central directory record."""
+  pos = 0
+  for _ in xrange(count):
+    record = central_dir[pos:pos + _CENTRAL_DIR.size]
+    if (len(record) != _CENTRAL_DIR.size or
+        not record.startswith(_CENTRAL_DIR_SIGNATURE)):
+      raise x5_exceptions.X5ZipError('Invalid zip central directory')
+    fields = _CENTRAL_DIR.unpack(record)
+    flags, compressed_size, size = fields[5], fields[10], fields[11]
+    name_length, extra_length, comment_length = fields[12:15]
+    pos += _CENTRAL_DIR.size
+    name = central_dir[pos:pos + name_length]
+    extra = central_dir[pos + name_length:pos + name_length + extra_length]
+    pos += name_length + extra_length + comment_length
+    if flags & _FLAG_ENCRYPTED:
+      raise x5_exceptions.X5ZipError('Encrypted zip entry %r' % name)
+    size, compressed_size = _zip64_sizes(extra, size, compressed_size)
+    yield X5ZipEntry(name, size, compressed_size)
+
+
+def validate(fetch, size, max_size=_MAX_TOTAL_SIZE):
+  """Validates a zipped bundle from its central directory.
+
+  Args:
+    fetch: a function returning the data between start and end offsets.
+    size: the size of the zip file.
+    max_size: the maximum total uncompressed size of the entries.
+
+  Returns:
+    An X5ZipManifest with the bundle entries, the names of the snippets and
+    the total uncompressed size.
+
+  Raises:
+    X5ZipError: if the file is not a zip archive, has no snippets, or
+        decompresses to a size over the limits.
+  """
+  tail_offset = max(0, size - _TAIL_SIZE)
+  tail = fetch(tail_offset, size)
+  entries_count, cd_size, cd_offset, cd_end = _end_of_central_dir(
+      tail, tail_offset
+  )
+  if entries_count > _MAX_ENTRIES:
+    raise x5_exceptions.X5ZipError('Too many zip entries: %s' % entries_count)
+  if cd_size > _MAX_CENTRAL_DIR_SIZE:
+    raise x5_exceptions.X5ZipError('Zip central directory too large')
+  # Data prepended to the archive shifts all offsets by the same amount.
+  cd_start = cd_end - cd_size
+  if cd_start < 0 or cd_start < cd_offset:
+    raise x5_exceptions.X5ZipError('Invalid zip central directory offset')
+  central_dir = tail[max(0, cd_start - tail_offset):cd_end - tail_offset]
+  if cd_start < tail_offset:
+    central_dir = fetch(cd_start, tail_offset) + central_dir
+
+  entries, snippets, total_size = [], [], 0
+  for entry in _entries(central_dir, entries_count):
+    if (entry.size > _RATIO_MIN_SIZE and
+        entry.size > entry.compressed_size * _MAX_RATIO):
+      raise x5_exceptions.X5ZipError(
+          'Zip entry %r compression ratio too high' % entry.name
+      )
+    total_size += entry.size
+    if total_size > max_size:
+      raise x5_exceptions.X5ZipError('Zip content too large')
+    if x5_bundle.skipped_member(entry.name):
+      continue
+    entries.append(entry)
+    if x5_bundle.snippet_member(entry.name):
+      snippets.append(entry.name)
+  if not snippets:
+    raise x5_exceptions.X5ZipError('No snippets found.')
+  return X5ZipManifest(entries, snippets, total_size)
+
@@ -0,0 +1,114 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+"""Tests for the upload time zip validation."""
+
+import io
+import unittest
+import zipfile
+
+import x5_exceptions
+import x5_zipcheck
+
+
+def _zip(entries, comment='', prefix='', compression=zipfile.ZIP_DEFLATED):
+  buf = io.BytesIO()
+  buf.write(prefix)
+  with zipfile.ZipFile(buf, 'a' if prefix else 'w', compression,
+                       allowZip64=True) as z:
+    for name, content in entries:
+      z.writestr(name, content)
+    z.comment = comment
+  return buf.getvalue()
+
+
+class X5ZipCheckTest(unittest.TestCase):
+
+  def _validate(self, data, **kwargs):
+    self.fetches = []
+
+    def fetch(start, end):
+      self.fetches.append((start, end))
+      return data[start:end]
+    return x5_zipcheck.validate(fetch, len(data), **kwargs)
+
+  def _assert_invalid(self, data, message, **kwargs):
+    with self.assertRaises(x5_exceptions.X5ZipError) as raised:
+      self._validate(data, **kwargs)
+    self.assertIn(message, raised.exception.args[0])
+
+  def test_manifest(self):
+    manifest = self._validate(_zip([
+        ('ad/', ''),
+        ('ad/index.html', '<html></html>'),
+        ('ad/a.js', 'var a;' * 10),
+        ('__MACOSX/ad/._a.js', 'x'),
+    ]))
+    self.assertEqual(manifest.snippets, ['ad/index.html'])
+    self.assertEqual(
+        [e.name for e in manifest.entries], ['ad/index.html', 'ad/a.js']
+    )
+    self.assertEqual(manifest.size, 13 + 60 + 1)
+    # The central directory is in the tail of a small archive.
+    self.assertEqual(len(self.fetches), 1)
+
+  def test_names_are_bytes(self):
+    manifest = self._validate(_zip([(u'd\xe9j\xe0.html', '<html></html>')]))
+    self.assertEqual(manifest.snippets, ['d\xc3\xa9j\xc3\xa0.html'])
+
+  def test_not_zip(self):
+    self._assert_invalid('hello world' * 100, 'Not a zip archive')
+    self._assert_invalid('', 'Not a zip archive')
+
+  def test_trailing_comment(self):
+    data = _zip([('index.html', '<html>')], comment='PK\x05\x06 comment')
+    self.assertEqual(self._validate(data).snippets, ['index.html'])
+
+  def test_prepended_data(self):
+    data = _zip([('index.html', '<html>')], prefix='#!/bin/sh\n' * 50)
+    self.assertEqual(self._validate(data).snippets, ['index.html'])
+
+  def test_bomb(self):
+    self._assert_invalid(
+        _zip([('index.html', '<html>'), ('a.txt', '\0' * (4 * 1024 * 1024))]),
+        'compression ratio too high'
+    )
+
+  def test_content_too_large(self):
+    data = _zip([('index.html', '<html>'), ('a.png', 'x' * 2000)],
+                compression=zipfile.ZIP_STORED)
+    self._assert_invalid(data, 'Zip content too large', max_size=1000)
+
+  def test_too_many_entries(self):
+    data = _zip([('index.html', '<html>')] + [
+        ('f%05d.txt' % i, '') for i in xrange(x5_zipcheck._MAX_ENTRIES)
+    ])
+    self._assert_invalid(data, 'Too many zip entries')
+
+  def test_no_snippet(self):
+    self._assert_invalid(_zip([('a.js', 'var a;')]), 'No snippets found')
+
+  def test_large_central_directory(self):
+    data = _zip([('f%04d.txt' % i, '') for i in xrange(3000)] + [
+        ('index.html', '<html>')
+    ])
+    manifest = self._validate(data)
+    self.assertEqual(len(manifest.entries), 3001)
+    # The tail, then the rest of the central directory.
+    self.assertEqual(len(self.fetches), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
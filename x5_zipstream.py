@@ -0,0 +1,159 @@
+#    Copyright 2018 Google Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Incremental zip archive writer.
+
+The standard zipfile module needs a seekable output to write sizes and CRCs
+in the local headers. This writer yields the archive as a sequence of byte
+strings instead, using data descriptors after each member, so that an
+archive of any number of members can be produced while only holding one
+chunk of member data in memory.
+"""
+
+import datetime
+import struct
+import zlib
+
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Bit 3: sizes and CRC are in the data descriptor after the data.
+_FLAG_DATA_DESCRIPTOR = 0x08
+# Bit 11: filename is encoded in utf-8.
+_FLAG_UTF8 = 0x800
+_VERSION = 20
+# Without zip64 extensions sizes and offsets are limited to 32 bits.
+_ZIP_LIMIT = 0xffffffff
+
+_LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+_DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+_CENTRAL_HEADER = struct.Struct('<4sBBHHHHHLLLHHHHHLL')
+_END_RECORD = struct.Struct('<4sHHHHLLH')
+
+
+class ZipStreamError(Exception):
+  """Raised when the archive exceeds the limits of the zip format."""
+  pass
+
+
+def _dos_datetime(dt):
+  dt = dt or datetime.datetime.utcnow()
+  if dt.year < 1980:
+    dt = datetime.datetime(1980, 1, 1)
+  return (
+      (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2),
+      ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+  )
+
+
+class ZipStream(object):
+  """Writes a zip archive as a stream of chunks.
+
+  Usage:
+
+    stream = ZipStream()
+    for name, chunks in members:
+      for data in stream.write(name, chunks):
+        out.write(data)
+    for data in stream.close():
+      out.write(data)
+  """
+
+  def __init__(self):
+    self._offset = 0
+    self._entries = []
+
+  @property
+  def offset(self):
+    """Number of bytes yielded so far."""
+    return self._offset
+
+  def _emit(self, data):
+    self._offset += len(data)
+    if self._offset > _ZIP_LIMIT:
+      raise ZipStreamError('Archive larger than 4GB')
+    return data
+
+  def write(self, arcname, chunks, date_time=None, compress_type=ZIP_STORED):
+    """Yields the archive bytes for a member built from an iterable of chunks.
+
+    Args:
+      arcname: the member name in the archive, str or unicode.
+      chunks: an iterable of byte strings with the member data.
+      date_time: the member modification datetime, defaults to now.
+      compress_type: ZIP_STORED or ZIP_DEFLATED.
+
+    Yields:
+      Byte strings forming the member in the archive.
+    """
+    flags = _FLAG_DATA_DESCRIPTOR
+    if isinstance(arcname, unicode):
+      arcname = arcname.encode('utf-8')
+      flags |= _FLAG_UTF8
+    dos_time, dos_date = _dos_datetime(date_time)
+    header_offset = self._offset
+    yield self._emit(_LOCAL_HEADER.pack(
+        'PK\x03\x04', _VERSION, flags, compress_type, dos_time, dos_date,
+        0, 0, 0, len(arcname), 0
+    ) + arcname)
+    crc, size, compress_size = 0, 0, 0
+    compressor = None
+    if compress_type == ZIP_DEFLATED:
+      compressor = zlib.compressobj(
+          zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+      )
+    for chunk in chunks:
+      if not chunk:
+        continue
+      crc = zlib.crc32(chunk, crc)
+      size += len(chunk)
+      if compressor is not None:
+        chunk = compressor.compress(chunk)
+        if not chunk:
+          continue
+      compress_size += len(chunk)
+      yield self._emit(chunk)
+    if compressor is not None:
+      chunk = compressor.flush()
+      compress_size += len(chunk)
+      yield self._emit(chunk)
+    if size > _ZIP_LIMIT:
+      raise ZipStreamError('Member %s larger than 4GB' % arcname)
+    crc &= 0xffffffff
+    yield self._emit(_DATA_DESCRIPTOR.pack(
+        'PK\x07\x08', crc, compress_size, size
+    ))
+    self._entries.append((
+        arcname, flags, compress_type, dos_time, dos_date, crc,
+        compress_size, size, header_offset
+    ))
+
+  def close(self):
+    """Yields the central directory, which ends the archive."""
+    directory_offset = self._offset
+    for (arcname, flags, compress_type, dos_time, dos_date, crc,
+         compress_size, size, header_offset) in self._entries:
+      yield self._emit(_CENTRAL_HEADER.pack(
+          'PK\x01\x02', _VERSION, 0, _VERSION, flags, compress_type,
+          dos_time, dos_date, crc, compress_size, size, len(arcname),
+          0, 0, 0, 0, 0, header_offset
+      ) + arcname)
+    count = len(self._entries)
+    if count > 0xffff:
+      raise ZipStreamError('More than 65535 members in archive')
+    yield self._emit(_END_RECORD.pack(
+        'PK\x05\x06', 0, 0, count, count,
+        self._offset - directory_offset, directory_offset, 0
+    ))